@@ -89,6 +89,8 @@ def main():
     basic.add_argument('--dump_map',action='store_true',help="dump kraken2 prelim and seq2taxid maps, required for files with multiseq")
     basic.add_argument('-nt', '--nt_source', '--nt', metavar="",type=str, default=False, help="If part of your data is merged into one file, add path to file here, example nt")
     basic.add_argument('-mfp', '--multifile_prefix', metavar="",type=str,default=False, help="If multiple datafiles, list file prefix to handle as multi files")
+    basic.add_argument('--db_profile', metavar="", default="safe", choices=["safe","bulk","readonly"], help="SQLite performance profile for the FlexTaxD database (safe, bulk, readonly) default safe")
+    basic.add_argument('--db_immutable', action='store_true', default=False, help="Workers open the database as immutable (no locking), only when no other process writes to the database")
 
     ### Download options, process local directory and potentially download files
     download_opts = parser.add_argument_group('download_opts', "Download and file handling")
@@ -166,6 +168,9 @@ def main():
             ])
     logger = logging.getLogger(__name__)
     logger.info("FlexTaxD-create logging initiated!")
+
+    '''Select the sqlite performance profile used by all database connections'''
+    dynamic_import("modules.database", "DatabaseConnection").set_profile(args.db_profile)
     logger.debug("Supported formats: {formats}".format(formats=programs))
 
     if args.dump_map:
@@ -207,10 +212,8 @@ def main():
             '''Create print out object'''
             write_module = dynamic_import("modules", "WriteTaxonomy")
             write_obj = write_module(args.tmpdir, database=args.database,prefix=dump_prefix,dbprogram=args.dbprogram,dump_genome_map=True)
-            '''Print database to file'''
-            write_obj.nodes()
-            write_obj.names()
-            write_obj.dump_taxid_map()
+            '''Print database to file, names, nodes and taxid maps are written in one pass'''
+            write_obj.export()
 
     if args.outdir:
         if not os.path.exists(args.outdir):
@@ -361,7 +364,8 @@ def main():
                                         debug=args.debug,
                                         verbose=args.verbose,
                                         tmpdir=args.tmpdir,
-                                        create_lib=args.create_lib
+                                        create_lib=args.create_lib,
+                                        immutable=args.db_immutable
         )
         report_time(current_time)
         if not skip:
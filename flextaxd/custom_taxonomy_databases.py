@@ -109,12 +109,14 @@ def main():
     basic.add_argument("--force", action='store_true',                              help="use when script is implemented in pipeline to avoid security questions on overwrite!")
     basic.add_argument('--validate', action='store_true',                           help="Validate database format")
     basic.add_argument('--stats', action='store_true',                              help="Print some statistics from the database")
+    basic.add_argument('--db_profile', metavar="", default="safe", choices=["safe","bulk","readonly"],  help="SQLite performance profile, bulk speeds up imports and modifications, readonly for dumps (default safe)")
 
     rmodules = get_read_modules()
     read_opts = parser.add_argument_group('read_opts', "Source options")
-    read_opts.add_argument('-tf', '--taxonomy_file',metavar="", default=None,                   help="Taxonomy source file")
+    read_opts.add_argument('-tf', '--taxonomy_file',metavar="", default=None, nargs="+",        help="Taxonomy source file, GTDB/QIIME (e.g. bac120 and ar53) and CanSNPer accept several files imported as one taxonomy")
     read_opts.add_argument('-tt', '--taxonomy_type',metavar="", default="", choices=rmodules,   help="Source format of taxonomy input file ({modules})".format(modules=",".join(rmodules)))
     read_opts.add_argument('--taxid_base', metavar="", type=int, default=1,                     help="The base for internal taxonomy ID numbers, when using NCBI as base select base at minimum 3000000 (default = 1)")
+    read_opts.add_argument('--processes', metavar="", type=int, default=1,                      help="Number of processes used to parse large source files such as accession2taxid or GTDB taxonomy files (default = 1)")
 
     mod_opts = parser.add_argument_group('mod_opts', "Database modification options")
     mod_opts.add_argument('-mf','--mod_file', metavar="", default=False,                help="File contaning modifications parent,child,(taxonomy level)")
@@ -122,6 +124,8 @@ def main():
     mod_opts.add_argument('-gt', '--genomeid2taxid', metavar="", default=False,         help="File that lists which node a genome should be assigned to")
     mod_opts.add_argument('-gp', '--genomes_path', metavar="",default=None,             help='Path to genome folder is required when using NCBI_taxonomy as source')
     mod_opts.add_argument('--force_multisource',  action='store_true', default=False,   help='Inputfiles contains multiple sources')
+    mod_opts.add_argument('--accession_index', metavar="", default=None,                help='SQLite file used as a persistent index of the NCBI accession2taxid file, built on first use and reused while the file is unchanged')
+    mod_opts.add_argument('--header_cache', metavar="", default=None,                   help='File caching the first FASTA header of each genome in --genomes_path, headers of unchanged files are not read again')
     
     #mod_opts.add_argument('-un', '--update_names', metavar="",default=None,             help='Update node names using old to new name file.')
     mod_opts.add_argument('--rename_from', metavar="",default=None,                     help='Updates a node name. Must be paired with --rename_to')
@@ -137,9 +141,12 @@ def main():
 
     out_opts = parser.add_argument_group('output_opts', "Output options")
     out_opts.add_argument('--dbprogram','--db_program', metavar="", default=False,choices=__programs_supported__,  help="Adjust output file to certain output specifications ["+", ".join(__programs_supported__)+"]")
+    out_opts.add_argument('--dump_programs', metavar="", default=False,                            help="Write names.dmp and nodes.dmp for several programs from one pass, comma separated list of kraken2,krakenuniq,bracken,ganon,minimal (one subfolder per program)")
     out_opts.add_argument("--dump_prefix", metavar="", default="names,nodes",                       help="change dump prefix reqires two names default(names,nodes)")
     out_opts.add_argument('--dump_sep', metavar="", default="\t|\t",                                help="Set output separator default(NCBI) also adds extra trailing columns for kraken")
+    out_opts.add_argument('--dump_compress', metavar="", default=False, choices=["gz","bz2","xz"],   help="Compress dump files (gz, bz2 or xz), gz files are compressed by --processes threads")
     out_opts.add_argument('--dump_descriptions', action='store_true', default=False,                help="Dump description names instead of database integers")
+    out_opts.add_argument('--dump_snapshot', action='store_true', default=False,                    help="Write the tree to a binary snapshot (taxonomy.snap) that is memory mapped by modules.TaxonomySnapshot")
     out_opts.add_argument('--dump_genomes', action='store_true', default=False,                     help="Print list of genomes (and source) to file")
     out_opts.add_argument('--dump_genome_annotations', action='store_true', default=False,          help="Add genome taxid annotation to genomes dump")
 
@@ -204,6 +211,9 @@ def main():
     logger = logging.getLogger(__name__)
     logger.info("FlexTaxD logging initiated!")
 
+    '''Select the sqlite performance profile used by all database connections'''
+    dynamic_import("modules.database", "DatabaseConnection").set_profile(args.db_profile)
+
     force = False
     if args.force:
         force = True
@@ -215,7 +225,7 @@ def main():
     if not os.path.exists(args.database) and not args.taxonomy_file:
         raise InputError("Database {db} does not exist and no source file was provided!".format(db=args.database))
     elif not os.path.exists(args.database) and args.taxonomy_file and not force:
-        ans = input("Creating a new FlexTaxD database {db} using {source}, press any key to continue...".format(db=args.database, source=args.taxonomy_file))
+        ans = input("Creating a new FlexTaxD database {db} using {source}, press any key to continue...".format(db=args.database, source=",".join(args.taxonomy_file)))
         if ans:
             pass
 
@@ -247,6 +257,10 @@ def main():
         if args.mod_file and not args.genomeid2taxid:
             raise InputError("Argument --mod_file with a genomeid to nodeid map is required when adding new nodes to the database!")
 
+    if args.taxonomy_file and len(args.taxonomy_file) > 1:
+        if not dynamic_import("modules", "ReadTaxonomy{type}".format(type=args.taxonomy_type)).multiple_files:
+            raise InputError("Taxonomy type {type} does not accept more than one --taxonomy_file".format(type=args.taxonomy_type or "default"))
+
     if args.genomeid2taxid and args.taxonomy_type == "NCBI":
         if not args.genomes_path:
             raise InputError("To annotate genomes to the NCBI database a path to genbank or refseq genomes folder needs to be given --genomes_path")
@@ -306,7 +320,7 @@ def main():
     if args.dump_genomes:
         logger.info("Dump list of genomes")
         write_module = dynamic_import("modules", "WriteTaxonomy")
-        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,dump_genomes=True)
+        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,dump_genomes=True,compression=args.dump_compress,threads=args.processes)
         if args.dump_genome_annotations:
             write_obj.dump_genome_annotations()
         else:
@@ -318,7 +332,10 @@ def main():
             '''Load taxonomy module'''
             logger.info("Loading module: ReadTaxonomy{type}".format(type=args.taxonomy_type))
             read_module = dynamic_import("modules", "ReadTaxonomy{type}".format(type=args.taxonomy_type))
-            read_obj = read_module(args.taxonomy_file, database=args.database,skip_annotation=args.skip_annotation,force_multisource=args.force_multisource)
+            taxonomy_file = args.taxonomy_file[0]
+            if len(args.taxonomy_file) > 1:
+                taxonomy_file = args.taxonomy_file                                              ## Several files are parsed in shards by the reader
+            read_obj = read_module(taxonomy_file, database=args.database,skip_annotation=args.skip_annotation,force_multisource=args.force_multisource,processes=args.processes,accession_index=args.accession_index,header_cache=args.header_cache)
             logger.info("Parse taxonomy")
             read_obj.parse_taxonomy()                                                           ## Parse taxonomy file
 
@@ -373,29 +390,36 @@ def main():
 
     ''' 2. Dump custom taxonomy database into NCBI/kraken readable format)'''
     if args.dump or args.dump_mini:
-        '''Check if datase exists if it does make sure the user intends to overwrite the file'''
-        nameprefix,nodeprefix = args.dump_prefix.split(",")
-        if (os.path.exists(args.outdir.rstrip("/")+"/"+nameprefix+".dmp") or os.path.exists(args.outdir.rstrip("/")+"/"+nameprefix+".dmp")) and not force:
-            ans = input("Warning: {names} and/or {nodes} already exists, overwrite? (y/n): ")
-            if ans not in ["y","Y","yes", "Yes"]:
-                exit("Dump already exists, abort!")
-
         '''Create print out object'''
         logger.info("Loading module: WriteTaxonomy".format(type=args.taxonomy_type))
         write_module = dynamic_import("modules", "WriteTaxonomy")
-        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram)
-
-        '''Print database to file'''
+        write_obj = write_module(args.outdir, database=args.database,prefix=args.dump_prefix,separator=args.dump_sep,minimal=args.dump_mini,desc=args.dump_descriptions,dbprogram=args.dbprogram,compression=args.dump_compress,threads=args.processes)
         if args.taxonomy_type == "NCBI":
             write_obj.set_minimal()
-        write_obj.nodes()
-        write_obj.names()
+        programs = False
+        if args.dump_programs:
+            programs = args.dump_programs.split(",")
+
+        '''Check if the dump files exist if they do make sure the user intends to overwrite them'''
+        existing = [path for path in write_obj.export_files(programs=programs, taxid_map=False) if os.path.exists(path)]
+        if existing and not force:
+            ans = input("Warning: {files} already exists, overwrite? (y/n): ".format(files=", ".join(existing)))
+            if ans not in ["y","Y","yes", "Yes"]:
+                exit("Dump already exists, abort!")
+
+        '''Print database to file'''
+        write_obj.export(programs=programs, taxid_map=False)
         if False: #args.taxDB:
             write_obj.set_separator("\t")
             write_obj.set_prefix("names,taxDB")
             write_obj.set_order(True)
             write_obj.nodes()
 
+    if args.dump_snapshot:
+        write_module = dynamic_import("modules", "WriteTaxonomy")
+        write_obj = write_module(args.outdir, database=args.database)
+        write_obj.snapshot()
+
     if args.vis_node:
         modify_module = dynamic_import("modules", "NewickTree")
         modify_obj = modify_module(database=args.database,taxid=args.vis_node,maxdepth=args.vis_depth,label_size=args.vis_label_size,vis_clip_labels=args.vis_clip_labels)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3 -c
+
+'''
+Open output files with compression chosen from the file suffix (.gz, .bz2 or .xz, anything else is written
+as plain text). Gzip output can be compressed by several threads, the data is then cut in blocks that are
+compressed as separate gzip members and written in order. A multi member gzip file is a standard gzip
+file (RFC 1952) and is read by gzip, zcat and the python gzip module as one stream.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import gzip
+import bz2
+import lzma
+import io
+import os
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+BLOCKSIZE = 1 << 22		## uncompressed bytes per gzip member
+COMPRESSLEVEL = 6		## same default as the gzip command
+
+def compression(path):
+	'''Compression of an output file given by its suffix
+
+	------
+	Returns
+		str - gz, bz2, xz or False for plain text
+	'''
+	for suffix in ["gz","bz2","xz"]:
+		if path.endswith("."+suffix):
+			return suffix
+	return False
+
+def open_output(path, mode="w", threads=1, buffering=-1, compresslevel=COMPRESSLEVEL):
+	'''Open a file for writing (mode w or wb), compressed according to the suffix of path. threads > 1
+		compresses gzip files in parallel (ParallelGzipWriter), bz2 and xz files are always compressed by one thread
+
+	------
+	Returns
+		file object
+	'''
+	method = compression(path)
+	if not method:
+		return open(path,mode,buffering=buffering)
+	if method == "gz" and threads > 1:
+		fileobj = ParallelGzipWriter(path,threads=threads,compresslevel=compresslevel)
+		if mode == "wb":
+			return fileobj
+		return io.TextIOWrapper(fileobj)
+	if mode == "w":
+		mode = "wt"  ## the compression modules open files in binary mode by default
+	if method == "gz":
+		return gzip.open(path,mode,compresslevel=compresslevel)
+	if method == "bz2":
+		return bz2.open(path,mode)
+	return lzma.open(path,mode)
+
+def compress_file(path, threads=1, suffix="gz"):
+	'''Compress a file in place like the gzip command, path is replaced by path.suffix
+
+	------
+	Returns
+		str - path of the compressed file
+	'''
+	target = "{path}.{suffix}".format(path=path,suffix=suffix)
+	with open(path,"rb") as source, open_output(target,"wb",threads=threads) as outputfile:
+		shutil.copyfileobj(source,outputfile,BLOCKSIZE)
+	shutil.copystat(path,target)
+	os.remove(path)
+	return target
+
+class ParallelGzipWriter(io.BufferedIOBase):
+	"""ParallelGzipWriter, binary file object that writes a multi member gzip file compressed by a pool of threads."""
+	def __init__(self, path, threads=2, compresslevel=COMPRESSLEVEL, blocksize=BLOCKSIZE):
+		super(ParallelGzipWriter, self).__init__()
+		self.name = path
+		self.fileobj = open(path,"wb")
+		self.compresslevel = compresslevel
+		self.blocksize = blocksize
+		self.threads = threads
+		self.executor = ThreadPoolExecutor(max_workers=threads)
+		self.pending = deque()		## compressed members in the order of the input
+		self.buffer = bytearray()
+		self.members = 0
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		'''Add data to the current block, full blocks are passed on to the compression threads
+
+		------
+		Returns
+			int - number of bytes written
+		'''
+		if self.closed:
+			raise ValueError("write to closed file {path}".format(path=self.name))
+		self.buffer += data
+		if len(self.buffer) >= self.blocksize:
+			self.submit()
+		return len(data)
+
+	def submit(self):
+		'''Compress the current block as one gzip member (zlib releases the GIL while compressing)'''
+		if not self.buffer:
+			return
+		self.pending.append(self.executor.submit(gzip.compress,bytes(self.buffer),self.compresslevel,mtime=0))
+		self.members += 1
+		self.buffer = bytearray()
+		## Keep the number of blocks in memory bounded, write finished members in order
+		while len(self.pending) > 2*self.threads or (self.pending and self.pending[0].done()):
+			self.fileobj.write(self.pending.popleft().result())
+
+	def flush(self):
+		'''Write all data given so far to the file, a flush ends the current gzip member'''
+		if self.closed or self.fileobj.closed:
+			return
+		self.submit()
+		while self.pending:
+			self.fileobj.write(self.pending.popleft().result())
+		self.fileobj.flush()
+
+	def close(self):
+		if self.closed:
+			return
+		try:
+			self.flush()
+			if not self.members:
+				self.fileobj.write(gzip.compress(b"",self.compresslevel,mtime=0))  ## an empty file is still a valid gzip file
+		finally:
+			## The file is closed before IOBase.close, its flush is then a no op and cannot fail a second time
+			self.executor.shutdown()
+			self.pending.clear()
+			self.buffer = bytearray()
+			try:
+				self.fileobj.close()
+			finally:
+				super(ParallelGzipWriter, self).close()
@@ -11,7 +11,7 @@ import random
 import os
 from multiprocessing import Process, Queue
 from subprocess import Popen,PIPE
-from .database.DatabaseConnection import DatabaseFunctions
+from .database.DatabaseConnection import DatabaseFunctions,worker_connection
 from time import sleep
 from gzip import BadGzipFile
 
@@ -30,17 +30,20 @@ def zopen(path,*args, **kwargs):
 
 class CreateGanonDB(object):
 	"""docstring for CreateGanonDB."""
-	def __init__(self, database, ganon_database, genome_names, outdir,verbose=False,debug=False,processes=1,limit=0,dbprogram="ganon",params="",create_db=False,skip=False,build_processes=False,usezip=False):
+	def __init__(self, database, ganon_database, genome_names, outdir,verbose=False,debug=False,processes=1,limit=0,dbprogram="ganon",params="",create_db=False,skip=False,build_processes=False,usezip=False,immutable=False):
 		super(CreateGanonDB, self).__init__()
 		self.database = DatabaseFunctions(database)
+		self.database_path = database
+		self.immutable = immutable  ## Workers skip locking only on request, the database may be written to while the library is built
 		if outdir == "":
 			outdir = "./"
 		self.outdir = outdir.rstrip("/")+"/"
 		self.params=params
 		self.seqid2taxid = self.outdir+"/seqid2taxid.map"
 		if os.path.exists(self.outdir+"/seqid2taxid.map"): open(self.seqid2taxid,"w").close() ## clean existing map if file exists
-		self.accession_to_taxid = self.database.get_genomes(self.database , limit=limit)
 		self.genome_names = list(genome_names.keys())   ## List for multiprocessing
+		if limit:
+			self.genome_names = self.genome_names[:limit]
 		self.genome_path = genome_names					## genome_id to path dictionary
 		self.files = []
 		self.usezip = ""
@@ -75,8 +78,24 @@ class CreateGanonDB(object):
 
 		return "Processes done"
 
+	def __getstate__(self):
+		'''Workers get a copy of the builder without the database connection of the parent process'''
+		state = self.__dict__.copy()
+		state.pop("database",None)
+		return state
+
+	def init_worker(self):
+		'''Worker initializer, opens the read only database connection of the worker process
+
+		------
+		Returns
+			DatabaseFunctions - connection owned by the worker
+		'''
+		return worker_connection(self.database_path, immutable=self.immutable)
+
 	def ganon_fasta(self,genomes,process):
 		'''Change fasta file to contain ganon fasta header'''
+		database = self.init_worker()
 		tmpname = ".tmp{rand}.fasta".format(rand=process)
 		tmpmapname =  ".tmp{rand}.map".format(rand=process)
 		tmppath = "{outdir}/{tmppath}".format(outdir=self.ganondb.rstrip("/"),tmppath=tmpname)
@@ -86,9 +105,8 @@ class CreateGanonDB(object):
 		for i in range(len(genomes)):
 			genome = genomes[i]
 			filepath = self.genome_path[genome]
-			try:
-				taxid = self.accession_to_taxid[genome]
-			except KeyError:
+			taxid = database.get_genome_taxid(genome)
+			if taxid is None:
 				logger.debug("# WARNING: {genome} could not be added to database".format(genome=genome))
 				continue
 			with zopen(filepath,"r") as f:
@@ -10,9 +10,12 @@ import gzip
 import random
 import os
 import glob
+import shutil
 from multiprocessing import Process,Manager,Pool
 from subprocess import Popen,PIPE,check_output,CalledProcessError
-from .database.DatabaseConnection import DatabaseFunctions
+from .database.DatabaseConnection import DatabaseFunctions,TreeError,worker_connection
+from .TaxonomyGraph import TaxonomyGraph
+from .CompressedOutput import open_output,compress_file,BLOCKSIZE
 from time import sleep
 
 '''gzip have changed their error format between python version 3.7 and 3.8, this is at least a temporary fix for that'''
@@ -38,10 +41,12 @@ def zopen(path,*args, **kwargs):
 
 class CreateKrakenDatabase(object):
 	"""docstring for CreateKrakenDatabase."""
-	def __init__(self, database, kraken_database, genome_names, outdir,verbose=False,processes=1,limit=0,dbprogram="kraken2",params="",skip="",create_db=False,debug=False,build_processes=None,**kwargs):
+	def __init__(self, database, kraken_database, genome_names, outdir,verbose=False,processes=1,limit=0,dbprogram="kraken2",params="",skip="",create_db=False,debug=False,build_processes=None,immutable=False,**kwargs):
 		super(CreateKrakenDatabase, self).__init__()
 		self.krakenversion = dbprogram
 		self.database = DatabaseFunctions(database)
+		self.database_path = database
+		self.immutable = immutable  ## Workers skip locking only on request, the database may be written to while the library is built
 		if outdir == "":
 			outdir = "./"
 		if not os.path.exists(outdir):
@@ -58,7 +63,6 @@ class CreateKrakenDatabase(object):
 			self.genome_path = genome_names					## genome_id to path dictionary
 		else:
 			logger.warning("Genome names are missing.") # Make sure your genomes are formatted as GCF_000000000.0.fasta[.gz]")
-		self.accession_to_taxid = self.database.get_genomes(self.database)
 		self.files = []
 		self.params = params
 		self.processes = processes
@@ -79,6 +83,7 @@ class CreateKrakenDatabase(object):
 		self.skiptax = set()
 		self.skipfiles = set()
 		self.skip = False
+		self.graph = False
 		if skip:
 			self.skip = True
 			if type(skip) == type(dict()):
@@ -95,18 +100,24 @@ class CreateKrakenDatabase(object):
 
 	def parse_taxid_names(self,skiptax):
 		'''Parse taxid names'''
-		taxidmap = self.database.get_nodes()
+		graph = self.taxonomy_graph()
 		newset = set()
 		for tid in skiptax:
 			if not tid.isdigit():
 				try:
-					newset.add(taxidmap[tid])
+					newset.add(graph.get_id(tid))
 				except KeyError:
 					logger.info("# WARNING: {taxa} not in database".format(taxa=tid))
 		if len(newset) > 0:
 			skiptax = newset
 		return skiptax
 
+	def taxonomy_graph(self):
+		'''TaxonomyGraph of the database, loaded on first use and shared by the skip functions'''
+		if not self.graph:
+			self.graph = TaxonomyGraph(self.database)
+		return self.graph
+
 	def _split(self,a, n):
 		k, m = divmod(len(a), n)
 		return list(a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
@@ -127,8 +138,24 @@ class CreateKrakenDatabase(object):
 		self.added = added.qsize()
 		return "Processes done"
 
+	def __getstate__(self):
+		'''Workers get a copy of the builder without the database connection of the parent process'''
+		state = self.__dict__.copy()
+		state.pop("database",None)
+		return state
+
+	def init_worker(self):
+		'''Worker initializer, opens the read only database connection of the worker process
+
+		------
+		Returns
+			DatabaseFunctions - connection owned by the worker
+		'''
+		return worker_connection(self.database_path, immutable=self.immutable)
+
 	def kraken_fasta_header(self,genomes,added):
 		'''Change fasta file to contain kraken fasta header'''
+		database = self.init_worker()
 		count = 0
 		batchint = random.randint(10**3,10**7)
 		tmpbatch = False
@@ -148,18 +175,16 @@ class CreateKrakenDatabase(object):
 			tmppath = "{tmpdir}/{tmppath}".format(tmpdir=self.tmpdir.rstrip("/"),tmppath=tmpname).rstrip(".gz")
 
 			'''Get taxid from database'''
-			try:
-				taxid = self.accession_to_taxid[genome]
-			except KeyError:
-				try:
-					taxid = self.accession_to_taxid[filepath.rsplit("/")[-1]]
-				except KeyError:
-					with open(tmplog, "a") as f:
-						print(genome,file=f)
-					count +=1
-					logger.debug("#Warning kraken header could not be added to {genome}! Total: {count}".format(genome=genome,count=count))
+			taxid = database.get_genome_taxid(genome)
+			if taxid is None:
+				taxid = database.get_genome_taxid(filepath.rsplit("/")[-1])
+			if taxid is None:
+				with open(tmplog, "a") as f:
+					print(genome,file=f)
+				count +=1
+				logger.debug("#Warning kraken header could not be added to {genome}! Total: {count}".format(genome=genome,count=count))
 
-					continue
+				continue
 			if not self.skip:
 				if len(set([taxid]) & self.skiptax) == 0:
 					'''Open temp file for manipulated (unzipped) genome fasta files'''
@@ -255,10 +280,15 @@ class CreateKrakenDatabase(object):
 		return self.skiptax
 
 	def parse_skip(self,skip):
-		'''Skip allows a list of tax ids to be passed and then excluded from the database'''
-		skiptax = []
+		'''Skip allows a list of tax ids (or names) to be passed and then excluded from the database together with their subtrees'''
+		graph = self.taxonomy_graph()
+		skiptax = set()
 		for t in skip:
-			skiptax |= self.taxonomydb.get_children()
+			try:
+				t = int(t) if t.isdigit() else graph.get_id(t)
+				skiptax |= set(graph.subtree(t))
+			except (KeyError,TreeError):
+				logger.info("# WARNING: {taxa} not in database".format(taxa=t))
 		return skiptax
 
 	def create_library_from_files(self,multifiles=False):
@@ -328,9 +358,13 @@ class CreateKrakenDatabase(object):
 
 		if self.krakenversion in ["kraken2"]:
 			logger.info("Create inspect file!")
-			os.system(self.krakenversion+"-inspect --db {krakendb} --report-zero-counts --threads {threads} > {krakendb}/inspect.txt".format(krakendb=self.krakendb,threads=self.build_processes ))
-			os.system("gzip {krakendb}/*.map".format(krakendb=self.krakendb))
-			os.system("gzip {krakendb}/inspect.txt".format(krakendb=self.krakendb))
+			## The inspect report is compressed while it is written, maps are compressed by build_processes threads
+			cmd = self.krakenversion+"-inspect --db {krakendb} --report-zero-counts --threads {threads}".format(krakendb=self.krakendb,threads=self.build_processes)
+			logger.info("{cmd} > {krakendb}/inspect.txt.gz".format(cmd=cmd,krakendb=self.krakendb))
+			with Popen(cmd,shell=True,stdout=PIPE) as inspect, open_output("{krakendb}/inspect.txt.gz".format(krakendb=self.krakendb),"wb",threads=self.build_processes) as outputfile:
+				shutil.copyfileobj(inspect.stdout,outputfile,BLOCKSIZE)
+			for mapfile in glob.glob("{krakendb}/*.map".format(krakendb=self.krakendb)):
+				compress_file(mapfile,threads=self.build_processes)
 		if not keep:
 			os.system(self.krakenversion+"-build --clean --db {krakendb}".format(outdir=outdir,krakendb=self.krakendb, threads=self.processes))
 			## re-add taxonomy
@@ -5,6 +5,7 @@ Modify tree from database or source
 '''
 
 from .database.DatabaseConnection import ModifyFunctions
+from .TaxonomyGraph import TaxonomyGraph
 import logging,os
 logger = logging.getLogger(__name__)
 import math
@@ -97,7 +98,10 @@ class ModifyTree(object):
 			if not os.path.exists(mod_database):
 				raise FileNotFoundError("The modification database was not found {path}".format(path=mod_database))
 			self.moddb = ModifyFunctions(mod_database,verbose=verbose)
-			self.identical_nodes = set(self.taxonomydb.get_nodes(col=2).keys()) & set(self.moddb.get_nodes(col=2).keys())
+			## Parents of identically named nodes are compared for every incoming link, both trees are loaded once
+			self.graph = TaxonomyGraph(self.taxonomydb)
+			self.modgraph = TaxonomyGraph(self.moddb)
+			self.identical_nodes = set(self.graph.names) & set(self.modgraph.names)
 			self.dbmod_annotation = self.moddb.get_nodes(col=1)
 			self.modsource = self.parse_modification(self.moddb,"database")
 			
@@ -172,7 +176,7 @@ class ModifyTree(object):
 			#print(set([desc]) & self.identical_nodes)
 			if len(set([desc]) & self.identical_nodes) > 0 and parent:
 				try:
-					if self.taxonomydb.get_name(self.taxonomydb.get_parent(self.taxonomydb.get_id(desc))[0]) != self.moddb.get_name(self.moddb.get_parent(self.moddb.get_id(desc))[0]):
+					if self.parent_name(self.graph,desc) != self.parent_name(self.modgraph,desc):
 						#print("Old: ",desc, i)
 						_i = i
 						self.do_not_delete_old.add(i)
@@ -202,6 +206,19 @@ class ModifyTree(object):
 			return i
 			
 
+	def parent_name(self, graph, desc):
+		'''Get the name of the parent of a node in a TaxonomyGraph, root is its own parent as in the tree table
+
+		------
+		Returns
+			str - name of the parent, raises TypeError if the node has no link (as a missing parent link in the database)
+		'''
+		taxid = graph.get_id(desc)
+		if graph.rank[graph.index[taxid]] < 0:
+			raise TypeError("{desc} has no parent".format(desc=desc))
+		parent = graph.get_parent(taxid)
+		return graph.get_name(taxid if parent is None else parent)
+
 	def _parse_new_links(self, parent=None,child=None,rank="no rank"):
 		'''Help function for parse_mod_file, gets existing node id or adds new node'''
 		## add new nodes
@@ -511,7 +528,7 @@ class ModifyTree(object):
 		self.all_nodes = set(self.taxonomydb.get_nodes(col=1).keys())
 		'''Add parents to all nodes that may not have annotations'''
 		logger.info("Retrieve all parents of annotated nodes")
-		self.annotated_nodes |= self.taxonomydb.get_parents(self.annotated_nodes,find_all=True,ncbi=ncbi)
+		self.annotated_nodes |= self.taxonomydb.get_parents(self.annotated_nodes,find_all=True)
 		logger.info("Parents added: {an}".format(an=len(self.annotated_nodes)-an))
 		if ncbi:
 			logger.info("Keep main nodes of the NCBI taxonomy (parents on level 3 and above)")
@@ -659,11 +676,11 @@ class ModifyTree(object):
 				self.taxonomydb.delete_nodes(self.old_nodes)
 			self.taxonomydb.query("vacuum") ## Actually remove the data from database
 		logger.debug("New links: [{links}]".format(links=self.new_links))
-		links,nodes = self.taxonomydb.add_links(self.new_links)
-		if len(links) + len(nodes) + len(self.non_overlapping_old_links) > 0:
+		added_links,ignored_links = self.taxonomydb.bulk_add_links(self.new_links,hold=True)
+		if added_links + len(self.non_overlapping_old_links) > 0:
 			if self.replace and len(self.old_nodes) > 0: logger.info("Deleted {n} links and {n2} nodes that are no longer valid".format(n=len(self.old_links | self.non_overlapping_old_links-set(self.parent_link)),n2=len(self.old_nodes)))
-			if len(self.new_nodes) > 1: logger.info("Adding {n} new nodes".format(n=len(nodes)))
-			if len(links) > 1: logger.info("Adding {n} new links".format(n=len(links)))
+			if len(self.new_nodes) > 1: logger.info("Adding {n} new nodes".format(n=len(self.new_nodes - self.existing_nodes)))
+			if added_links > 1: logger.info("Adding {n} new links ({ignored} already existed)".format(n=added_links,ignored=ignored_links))
 
 			''' Commit changes (only commit once both deletion and addition of new nodes and links are completed!)'''
 			self.taxonomydb.commit()
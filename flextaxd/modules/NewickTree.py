@@ -3,6 +3,7 @@ Module to read and write newick trees
 
 '''
 from flextaxd.modules.database.DatabaseConnection import ModifyFunctions
+from flextaxd.modules.TaxonomyGraph import TaxonomyGraph
 from io import StringIO
 import importlib.util
 
@@ -119,7 +120,7 @@ class NewickTree(object):
 		self.c_p_set = set()
 		self.tree_file = "{outdir}/{name}_tree.pdf".format(outdir=outdir.rstrip("/"),name=name) ## output file
 		self.tmp_tree = "{outdir}/.newick"
-		self.taxonomy = self.database.get_nodes()
+		self.graph = TaxonomyGraph(self.database)	## id and name lookups without database calls
 		## Build the newick tree
 		self.maxdepth = maxdepth
 		self.label_size = label_size
@@ -128,9 +129,8 @@ class NewickTree(object):
 
 		## Check difference between database and constructed tree
 		# Get nodes from database
-		db_index_nodes = self.get_nodes(col=1)
 		db_nodes = set()
-		for index,node in db_index_nodes.items():
+		for node in self.graph.names:
 			if node == 'cellular organisms': continue # do not add this arbitrary taxonomy
 			db_nodes.add(node.lower())
 		#/
@@ -217,10 +217,9 @@ class NewickTree(object):
 	def double_opts_vis(self,links,taxid="name",full=False):
 		'''vis double opt'''
 		import inquirer
-		tn = self.database.get_nodes()
 		if taxid != "name":
-			taxid = tn[taxid]
-		parents = [tn[x[0]] for x in links]
+			taxid = self.graph.get_name(taxid)
+		parents = [self.graph.get_name(x[0]) for x in links]
 		questions = [
 		  inquirer.List('parent',
 		                message="The node {name} has multiple optional parents, select which line to visualise: ".format(name=taxid),
@@ -228,7 +227,7 @@ class NewickTree(object):
 		            ),
 		]
 		answers = inquirer.prompt(questions)
-		selected = tn[answers["parent"]] ## Return back to id
+		selected = self.graph.get_id(answers["parent"]) ## Return back to id
 		taxids = []
 		unique = set()
 		for link in links:
@@ -259,11 +258,9 @@ class NewickTree(object):
 		'''
 		selected = False
 		if taxid:
-			if maxdepth == 0:
-				maxdepth = 1000  ## It is not reasonable to expect trees with more than 1000 levels, if so bug has to be raised
 			'''Check if double parent'''
 			links = self.database.get_links([taxid],order=True)
-			nodes = self.database.get_node(self.taxonomy[taxid])
+			nodes = self.database.get_node(self.graph.get_name(taxid))
 			find_tax = [taxid]
 			if len(nodes) > len(links):
 				links = self.database.get_links(nodes,order=True)
@@ -300,20 +297,17 @@ class NewickTree(object):
 	def get_parent(self,name):
 		'''return parent'''
 		#QUERY = '''SELECT parent,child,rank FROM tree LEFT JOIN rank on (tree.rank_i = rank.rank_i) WHERE child = "{node}"'''.format(node=name)
-		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = "{node}"'''.format(node=name)
-		logger.debug(QUERY)
-		res = self.database.query(QUERY).fetchone()
-		return res
+		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = ?'''
+		return self.database.fetch_one(QUERY,(name,))
 
 	def get_child(self,name,rank_i=False):
 		'''return child'''
 		#QUERY = '''SELECT child,child,rank FROM tree LEFT JOIN rank on (tree.rank_i = rank.rank_i) WHERE child = "{node}"'''.format(node=name)
-		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE parent = "{node}"'''.format(node=name)
 		if rank_i:
-			QUERY = '''SELECT parent,child,rank_i FROM tree WHERE parent = "{node}" and rank_i ={rank}'''.format(node=name,rank=rank_i)
-		logger.debug(QUERY)
-		res = self.database.query(QUERY).fetchone()
-		return res
+			QUERY = '''SELECT parent,child,rank_i FROM tree WHERE parent = ? and rank_i = ?'''
+			return self.database.fetch_one(QUERY,(name,rank_i))
+		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE parent = ?'''
+		return self.database.fetch_one(QUERY,(name,))
 
 	def new_node(self,child,nodes,parent,link=1):
 		'''Function that adds a new node to the newick tree'''
@@ -343,7 +337,7 @@ class NewickTree(object):
 				t_parent,t_child,rank = self.get_parent(parent)
 			except KeyError:
 				raise Error("Something is wrong")
-			logger.debug("Adding parent: [{parent},{pname}] of child: [{child},{cname}]".format(parent=t_parent,pname=self.taxonomy[t_parent],cname=self.taxonomy[t_child],child=t_child))
+			logger.debug("Adding parent: [{parent},{pname}] of child: [{child},{cname}]".format(parent=t_parent,pname=self.graph.get_name(t_parent),cname=self.graph.get_name(t_child),child=t_child))
 			if self.new_node(t_child,nodes,t_parent,link=link-1): ## Add the missing parent
 				self.new_node(child,nodes,parent,link)	  ## Try again to add the node
 			else:
@@ -355,18 +349,19 @@ class NewickTree(object):
 
 	def unique_indexes(self,nodes):
 		'''Check duplicated indexes and give them unique IDs before print'''
-		QUERY = "SELECT child FROM tree WHERE child in ({nodes}) GROUP BY child HAVING count(parent) > 1 ".format(nodes=",".join(map(str,nodes)))  ## Thanks to andrewjmc@github for this suggestion
+		nodes = self.database.temp_table(nodes,name="unique_nodes")
+		QUERY = "SELECT child FROM tree WHERE child in (SELECT id FROM {nodes}) GROUP BY child HAVING count(parent) > 1 ".format(nodes=nodes)  ## Thanks to andrewjmc@github for this suggestion
 		child_w_dpi = self.database.query(QUERY).fetchall()  ## Fetch all conflicting links and give them unique index before printing
 		child_w_dpi = list(*child_w_dpi)
 		return child_w_dpi
 
-	def fix_names(self,nodes,tn,tr):
+	def fix_names(self,nodes,tr):
 		'''Return names instead of taxid'''
 		nnodes = []
 		for x in range(len(nodes)):
 			fixnames = list(nodes[x])
-			fixnames[0] = tn[fixnames[0]]
-			fixnames[1] = tn[fixnames[1]]
+			fixnames[0] = self.graph.get_name(fixnames[0])
+			fixnames[1] = self.graph.get_name(fixnames[1])
 			fixnames[2] = tr[fixnames[2]]
 			nnodes.append(fixnames)
 		return nnodes
@@ -375,18 +370,17 @@ class NewickTree(object):
 	def double_vis_path(self,duplicates,taxid,nodes):
 		'''The range in the tree has two identical nodes, ask user to resolve which path goes where'''
 		import inquirer,random
-		tn = self.database.get_nodes()
 		tr = self.database.get_rank()
 		children = self.database.get_links(self.database.get_children([taxid],maxdepth=1))
 		parents = duplicates[taxid]
 		if len(children) > 2:
 			raise VisualisationError("Names occuring three times in the same tree are not taken care of at this time, export function does however!")
-		children_N = self.fix_names(children,tn,tr)
-		parents_N = self.fix_names(parents,tn,tr)
+		children_N = self.fix_names(children,tr)
+		parents_N = self.fix_names(parents,tr)
 		selto = parents_N[0]
 		default = children_N[0]
 		if taxid != "name":
-			taxid = tn[taxid]
+			taxid = self.graph.get_name(taxid)
 		questions = [
 		  inquirer.List('parent',
 		                message="The node {name} has two paths, select the correct path to ({p1})".format(name=taxid,p1=selto,children=children_N),
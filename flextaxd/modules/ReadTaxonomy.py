@@ -2,14 +2,31 @@
 
 '''
 Read SILVA taxonomy dmp files (nodes or names) and holds a dictionary
+
+Readers implement records(), a generator of normalized Node, Link, Rank and Genome records, and the
+shared loader (ReadTaxonomy.load) assigns node ids and writes the records to the database in bulk.
+A new format is added as a module ReadTaxonomy{type}.py with a class ReadTaxonomy{type} in the
+modules folder, it is then available as --taxonomy_type {type}.
 '''
 
 from .database.DatabaseConnection import DatabaseFunctions
+from collections import namedtuple
 import logging
 import gzip
 import sys
+import time
 logger = logging.getLogger(__name__)
 
+## Normalized records yielded by readers, Link and Genome records refer to nodes by id (int) or by name (str)
+Node = namedtuple("Node", ["name","id"], defaults=[None])						## id None gives the next free id, a known name is not added again
+Link = namedtuple("Link", ["parent","child","rank"], defaults=["no rank"])		## rank is a rank key, see Rank
+Rank = namedtuple("Rank", ["rank","name"], defaults=[None])					## rank key used by links and the rank name stored (default the key)
+Genome = namedtuple("Genome", ["genome","node","reference"], defaults=[False])
+Block = namedtuple("Block", ["type","rows"])									## rows of one record type as plain tuples in field order
+
+CHUNKSIZE = 100000		## records between writes of pending rows to the database
+PROGRESS = 1000000		## records between progress messages
+
 class InputError(Exception):
 	"""Exception raised for errors in the input."""
 	def __init__(self, message):
@@ -18,6 +35,8 @@ class InputError(Exception):
 
 class ReadTaxonomy(object):
 	"""docstring for ReadTaxonomy."""
+	multiple_files = False		## True if the reader accepts a list of taxonomy files
+	index_names = True			## Keep a name to id index of loaded nodes (self.taxonomy), required when records refer to nodes by name
 	def __init__(self, taxonomy_file=False, taxonomy_name=False, database=False,verbose=False,**kwargs):
 		super(ReadTaxonomy, self).__init__()
 		### Connect to or create database
@@ -57,8 +76,10 @@ class ReadTaxonomy(object):
 
 	#@staticmethod
 	def parse_taxonomy(self,treefile=False):
-		'''Parse taxonomy information'''
-		self.read_nodes(treefile=treefile)
+		'''Parse taxonomy information, the records of the reader are written to the database by load'''
+		if treefile:
+			self.taxonomy_file = treefile
+		self.load(self.records())
 
 	def set_separator(self,sep):
 		'''Change separator from default (\t)'''
@@ -99,14 +120,138 @@ class ReadTaxonomy(object):
 		return self.taxid_base
 
 
-	def read_nodes(self, treefile=False):
-		'''Read a tab separated node file and store a dictionary with names in object'''
-		logger.info("Read nodes in taxonomy file {}".format(treefile))
+	def load(self, records, chunksize=CHUNKSIZE):
+		'''Load normalized records (Node, Link, Rank, Genome) into the database. Records are handled in
+			the order they are yielded, a reader may check self.taxonomy for nodes loaded before. A reader
+			may also yield a Block of rows of one record type (e.g. all rows of a block of input) to save
+			the per record overhead. Node ids are assigned from the current max id, rows are written in bulk
+			within one transaction and the secondary indexes of nodes, tree and genomes are rebuilt after the load
+
+		------
+		Returns
+			dict - number of records loaded per record type
+		'''
+		handlers = {Node: self.load_nodes, Link: self.load_links, Rank: self.load_ranks, Genome: self.load_genomes}
+		counts = dict.fromkeys(handlers,0)
+		self.pending = {"nodes": [], "tree": [], "genomes": []}
+		self.max_id = self.database.fetch_one("SELECT MAX(id) FROM nodes")[0] or 0
+		self.added = 0
+		start = time.time()
+		indexes = self.database.drop_indexes(("nodes","tree","genomes"))
+		try:
+			loaded = 0
+			flush_at = chunksize
+			progress_at = PROGRESS
+			for block in records:
+				_type = type(block)
+				if _type is Block:
+					_type,block = block
+					if not block:
+						continue
+				else:
+					block = (block,)
+				try:
+					handler = handlers[_type]
+				except KeyError:
+					raise InputError("Unknown taxonomy record type {type}".format(type=_type))
+				handler(block)
+				counts[_type] += len(block)
+				loaded += len(block)
+				if loaded >= flush_at:
+					self.flush()
+					flush_at = loaded + chunksize
+				if loaded >= progress_at:
+					logger.info("{n} records loaded ({rate:.0f} records/s)".format(n=loaded,rate=loaded/(time.time()-start)))
+					progress_at = loaded + PROGRESS
+			self.flush()
+			self.database.commit()
+		finally:
+			self.database.create_indexes(indexes)
+		counts = {_type.__name__: n for _type,n in counts.items()}
+		logger.info("Records loaded {counts} in {time:.1f}s".format(counts=counts,time=time.time()-start))
+		return counts
+
+	def flush(self):
+		'''Write pending nodes, links and genomes to the database (the transaction is kept open)'''
+		inserted,ignored = self.database.bulk_add_nodes(self.pending["nodes"],hold=True)
+		self.length += inserted
+		inserted,ignored = self.database.bulk_add_links(self.pending["tree"],hold=True)
+		self.ids += inserted
+		inserted,ignored = self.database.bulk_add_genomes(self.pending["genomes"],hold=True)
+		self.added += inserted
+		self.pending = {"nodes": [], "tree": [], "genomes": []}
+
+	def node_id(self, node):
+		'''Translate a node reference (id or name) of a record to the node id'''
+		if type(node) is int:
+			return node
+		try:
+			return self.taxonomy[node]
+		except KeyError:
+			raise InputError("Node {node} is referenced before it was added".format(node=node))
+
+	def load_nodes(self, block):
+		'''Assign ids to Node records, nodes without id that are already known are not added again'''
+		nodes = self.pending["nodes"]
+		ids = [_id for name,_id in block]
+		if not self.index_names and None not in ids:
+			## Nodes with given ids only need the max id to be tracked
+			self.max_id = max(self.max_id,max(ids))
+			nodes += zip(ids,(name for name,_id in block))
+			return
+		taxonomy = self.taxonomy
+		for name,_id in block:
+			if _id is None:
+				if name in taxonomy:
+					continue
+				if name.strip() == "":  ## empty nodes are not added
+					taxonomy[name] = False
+					continue
+				self.max_id += 1
+				_id = self.max_id
+			elif _id > self.max_id:
+				self.max_id = _id
+			if self.index_names:
+				taxonomy[name] = _id
+			nodes.append((_id,name))
+
+	def load_ranks(self, block):
+		'''Add the ranks of Rank records, known rank keys are skipped'''
+		for rank,name in block:
+			if rank not in self.rank:
+				self.rank[rank] = self.database.add_rank(name or rank)
+
+	def load_links(self, block):
+		'''Add Link records, a rank key that is not known is added as a rank with the same name'''
+		ranks = self.rank
+		taxonomy = self.taxonomy
+		try:
+			links = [(parent if type(parent) is int else taxonomy[parent],child if type(child) is int else taxonomy[child],ranks[rank]) for parent,child,rank in block]
+		except KeyError:
+			self.load_ranks([Rank(rank) for parent,child,rank in block])
+			links = [(self.node_id(parent),self.node_id(child),ranks[rank]) for parent,child,rank in block]
+		self.pending["tree"] += links
+
+	def load_genomes(self, block):
+		'''Add Genome records'''
+		taxonomy = self.taxonomy
+		try:
+			genomes = [(genome,node if type(node) is int else taxonomy[node],reference) for genome,node,reference in block]
+		except KeyError:
+			genomes = [(genome,self.node_id(node),reference) for genome,node,reference in block]
+		self.pending["genomes"] += genomes
+
+	def records(self):
+		'''Read a tab separated node file (child, parent and an optional rank column)
+
+		------
+		Returns
+			generator - normalized taxonomy records
+		'''
+		logger.info("Read nodes in taxonomy file {}".format(self.taxonomy_file))
 		swap = False
 		rank = "no rank"  #Base rank if rank is not used
-		if not treefile:
-			treefile = self.taxonomy_file
-		with self.zopen(treefile, "r") as _treefile:
+		with self.zopen(self.taxonomy_file, "r") as _treefile:
 			headers = _treefile.readline().strip().split(self.sep)
 			if "parent" not in headers or "child" not in headers:
 				logger.debug("Headers:  {h} separator [{sep}]".format(h=headers,sep=self.sep))
@@ -116,49 +261,41 @@ class ReadTaxonomy(object):
 			logger.debug("Swap: {swap}".format(swap=swap))
 			for tree_row in _treefile:
 				data = tree_row.strip().split(self.sep)
-				logger.debug(data)
 				if len(data) > 2:
 					rank = data.pop().strip()
-					if rank.strip() != "":
-						self.add_rank(rank)
+					if rank != "":
+						yield Rank(rank)
 				if swap:
 					data[0],data[1] = data[1],data[0]
-				'''Add nodes into database'''
 				if data[0] == "":
 					'''Check for empty rows'''
 					continue
 				for node in data:
-					logger.debug(node)
-					node = node.strip()
-					try:
-						self.taxonomy[node]
-					except KeyError:
-						logger.debug("Add node: {node}".format(node=node))
-						self.taxonomy[node] = self.add_node(node)
-						self.ids +=1
-				#logger.debug("Add link: {parent}-{child}".format(parent=data[1].strip(),child=data[0].strip()))
-				self.add_link(child=self.taxonomy[data[0].strip()],parent=self.taxonomy[data[1].strip()],rank=rank)
-				self.length +=1
-			self.database.commit()
+					yield Node(node.strip())
+				yield Link(data[1].strip(),data[0].strip(),rank)
 
 	def parse_genomeid2taxid(self,genomeid2taxid,reference=False):
 		'''Parse file that annotates genome_id´s to nodes in the tree'''
 		nodeDict = self.database.get_nodes()
-		_ref = reference
 		with self.zopen(genomeid2taxid,"rt") as f:
 			# headers = f.readline().strip().split("\t") # This line was commented away since this genomeid2taxid is not documented to have a header
-			for row in f:
-				if row.strip() != "": ## If there are trailing empty lines in the file
-					try:
-						genomeid,taxid = row.strip().split("\t")
-					except:
-						if not _ref: ## override if there is a reference in file, and use given ref
-							genomeid,taxid,reference = row.strip().split("\t")
-						else:
-							genomeid,taxid,override = row.strip().split("\t")
-					try:
-						self.database.add_genome(genome=genomeid.strip(),_id=nodeDict[taxid.strip()],reference=reference)
-					except KeyError:
-						logger.warning("# WARNING: {taxid} not found in the database".format(taxid=taxid))
-			self.database.commit()
+			inserted,ignored = self.database.bulk_add_genomes(self._parse_genomeid2taxid(f,nodeDict,reference))
+		logger.info("Genomes added: {inserted}, ignored: {ignored}".format(inserted=inserted,ignored=ignored))
 		return
+
+	def _parse_genomeid2taxid(self,f,nodeDict,reference=False):
+		'''Generator of (genome, taxid, reference) from a genomeid2taxid file'''
+		_ref = reference
+		for row in f:
+			if row.strip() != "": ## If there are trailing empty lines in the file
+				try:
+					genomeid,taxid = row.strip().split("\t")
+				except:
+					if not _ref: ## override if there is a reference in file, and use given ref
+						genomeid,taxid,reference = row.strip().split("\t")
+					else:
+						genomeid,taxid,override = row.strip().split("\t")
+				try:
+					yield genomeid.strip(),nodeDict[taxid.strip()],reference
+				except KeyError:
+					logger.warning("# WARNING: {taxid} not found in the database".format(taxid=taxid))
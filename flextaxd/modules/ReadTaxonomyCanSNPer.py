@@ -13,7 +13,7 @@ __email__ = "bioinformatics@foi.se"
 __date__ = "2020-01-17"
 __status__ = "Production"
 
-from .ReadTaxonomy import ReadTaxonomy
+from .ReadTaxonomy import ReadTaxonomy,Node,Link,Block,CHUNKSIZE
 import logging
 logger = logging.getLogger(__name__)
 
@@ -26,9 +26,12 @@ class ImportFormatError(Exception):
 
 class ReadTaxonomyCanSNPer(ReadTaxonomy):
 	"""docstring for ReadTaxonomyCanSNPer."""
+	multiple_files = True
 	def __init__(self, taxonomy_file=False, database=".canSNPdb",  taxid_base=1,root_name=False,rank="family", verbose=False,**kwargs):
-		super(ReadTaxonomyCanSNPer, self).__init__(taxonomy_file=taxonomy_file, database=database,cnp=False,verbose=verbose,**kwargs)
+		super(ReadTaxonomyCanSNPer, self).__init__(taxonomy_file=taxonomy_file, database=database,verbose=verbose,**kwargs)
 		self.input = taxonomy_file
+		if not isinstance(taxonomy_file,(list,tuple)):
+			self.input = [taxonomy_file]
 		self.taxonomy = {}
 		self.taxid_num = taxid_base
 		## Initiate database
@@ -36,27 +39,27 @@ class ReadTaxonomyCanSNPer(ReadTaxonomy):
 		logger.debug(root_name)
 		if not root_name:
 			logger.info("Fetching root name from file")
-			root_name = self.get_root_name(taxonomy_file)
-		logger.info("Adding, cellular organism node")
-		c_i = self.add_node("cellular organisms")
-		logger.info("Adding root node {node}!".format(node=root_name))
-		if not cnp:
-			logger.info("Adding, cellular organism node")
-			c_i = self.add_node("cellular organisms")
-			logger.info("Adding root node {node}!".format(node=root_name))
-		root_i = self.add_node(root_name)
-		self.taxid_num =taxid_base ## reset
+			root_name = self.get_root_name(self.input[0])
 		logger.debug("Adding ranks!")
 		if rank != "no rank":
 			self.add_rank("no rank")
 		self.add_rank(rank)
-		if root_name != "cellular organisms" and not cnp:
-			self.add_link(c_i,1)
-		if root_name != "root" and not cnp:
+		logger.info("Adding, cellular organism node")
+		c_i = self.add_node("cellular organisms")
+		self.add_link(c_i,1)
+		if root_name == "root":
+			root_i = 1
+			self.taxonomy[root_name] = root_i
+		elif root_name == "cellular organisms":
+			root_i = c_i
+		else:
+			logger.info("Adding root node {node}!".format(node=root_name))
+			root_i = self.add_node(root_name)
 			self.add_link(root_i,c_i,rank=rank) ## root is always added as top parent if not one force 1
-			self.taxonomy[root_i] = 1  ## Add local link to root
 		self.names = {}
 		self.root = root_i
+		self.cellular = c_i
+		self.root_rank = rank
 		self.length = 0
 		self.ids = 0
 
@@ -73,47 +76,106 @@ class ReadTaxonomyCanSNPer(ReadTaxonomy):
 				root = root[0]
 		return root
 
-	def add_SNP(self,nodes,i):
-		'''Add name of node to database'''
-		name = nodes[i].strip()
-		logger.debug("Parent did not exit Add parent: {name}".format(name=name))
+	def known(self,name):
+		'''Check if a node is loaded or collected'''
+		return name in self.taxonomy or name in self.new_names
+
+	def add_SNP(self,name,parent):
+		'''Collect a new node and its link to the parent (node name or id)'''
+		self.nodes.append((name,None))
+		self.links.append((parent,name,"no rank"))
+		self.new_names.add(name)
+
+	def add_tree(self,path):
+		'''Add the root of a further tree file, a root that is not in the taxonomy yet is placed
+			next to the root of the first file (under cellular organisms)
+
+		------
+		Returns
+			str - name of the root of the tree
+		'''
+		root = self.get_root_name(path)
+		if not self.known(root):
+			logger.info("Adding root node {node}!".format(node=root))
+			self.nodes.append((root,None))
+			self.links.append((self.cellular,root,self.root_rank))
+			self.new_names.add(root)
+		return root
+
+	def parse_lineage(self,nodes,top):
+		'''Resolve the parent of the last node of a lineage (list of node names from the top down).
+			The lineage above the node is looked up in the lineage cache, otherwise it is walked from
+			the bottom up until a known node is found (the top of an unknown lineage is placed under
+			top, the root of the file) and the missing parents are added from the top down
 
-		#i-=1 ## Check next parent
+		------
+		Returns
+			str - name of the last node of the lineage
+		'''
+		lineage = ";".join(nodes[:-1])
 		try:
-			parent_i = self.taxonomy[nodes[i-1]]  ## check if current nodes parent exists
-		except KeyError:                          ## Parent did not exist, keep walking up the tree and add all parents until root!
-			if i < -len(nodes):
-				return self.root                ## The root has been reached return index of root
-			else:                                ## Parent didn't exist again, add parent to this node and then add the link to that parent
-				parent_i = self.add_SNP(nodes,i-1)## Add node of parent
-		node_i = self.add_node(name)  ## Add node
-		if node_i:
-			self.taxid_num += 1
-		self.add_link(node_i, parent_i)            ## Add link to next parent
-		return node_i     ##  index of child
+			parent = self.lineage_cache[lineage]
+		except KeyError:
+			i = len(nodes)-2
+			while i >= 0 and not self.known(nodes[i]):
+				i -= 1
+			parent = nodes[i] if i >= 0 else top
+			for name in nodes[i+1:-1]:
+				logger.debug("Parent did not exist add parent: {name}".format(name=name))
+				self.add_SNP(name,parent)
+				parent = name
+			self.lineage_cache[lineage] = parent
+		child = nodes[-1]
+		if not self.known(child):
+			self.add_SNP(child,parent)
+		return child
 
 	def parse_taxonomy(self):
 		'''Retrieve node description from CanSNPer formatted tree'''
 		logger.info("Parse CanSNP tree file")
-		with self.zopen(self.taxonomy_file,"r") as f:
-			for row in f:
-				row = row.strip().replace("\t",";")  ## Also accept tab separated tree files
-				nodes = row.strip().split(";")  ## get node and all its parents in a list
-				logger.debug(nodes)
-				child = nodes[-1]  ## get name of child node
-				'''If the tree was not properly formatted an a parent is missing make sure that function works anyway by adding any parent node above child'''
-				try:
-					pname = nodes[-2].strip()
-					parent_i = self.taxonomy[pname]  ## Check if parent of child node exists
-				except KeyError: ## parent node does not exist, add parent
-					parent_i = self.add_SNP(nodes,-2)
-				except IndexError: ## Should be first row with only one node (parent)
-					self.taxonomy[child] = self.root
-					parent_i = self.root
-					continue
-				'''Now all parents exists, add new child node and add the link'''
-				child_i = self.add_node(child)
-				self.database.add_link(child_i,parent_i)
-		self.database.commit()
-		self.length = self.taxid_num - self.root                ## Check number of new nodes added
+		self.load(self.records())
 		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
+
+	def records(self):
+		'''Read CanSNPer tree files in order, one lineage per row (; or tab separated), each row adds the
+			last node of the lineage and any missing parent. Every file after the first is a tree of its own,
+			rows of one file are resolved against all nodes read before
+
+		------
+		Returns
+			generator - Blocks of Node and Link records
+		'''
+		self.lineage_cache = {}
+		self.nodes,self.links = [],[]
+		self.new_names = set()  ## Names of collected nodes that are not loaded yet
+		for n,path in enumerate(self.input):
+			top = self.root
+			if n > 0:
+				logger.info("Parse CanSNP tree file {path}".format(path=path))
+				top = self.add_tree(path)
+			with self.zopen(path,"r") as f:
+				for row in f:
+					row = row.strip().replace("\t",";")  ## Also accept tab separated tree files
+					if row == "":
+						continue
+					nodes = [node.strip() for node in row.split(";")]  ## get node and all its parents in a list
+					if len(nodes) == 1: ## Should be first row with only one node (parent)
+						if n == 0:
+							self.taxonomy[nodes[0]] = self.root
+						continue
+					self.parse_lineage(nodes,top)
+					if len(self.nodes) >= CHUNKSIZE:
+						yield from self.collected()
+		yield from self.collected()
+
+	def collected(self):
+		'''Hand over the collected nodes and links
+
+		------
+		Returns
+			generator - Blocks of Node and Link records
+		'''
+		yield Block(Node,self.nodes)
+		yield Block(Link,self.links)
+		self.nodes,self.links = [],[]
+		self.new_names = set()
@@ -4,15 +4,153 @@
 Read NCBI taxonomy dmp files (nodes or names) and holds a dictionary
 '''
 
-from .ReadTaxonomy import ReadTaxonomy
+from .ReadTaxonomy import ReadTaxonomy,Node,Link,Rank,Block
+from .database.AccessionIndex import AccessionIndex
+from .functions import imap_bounded
 from gzip import open as zopen
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
 import zlib
+import re
 import os
+import mmap
+import shutil
+import subprocess
 import logging
 logger = logging.getLogger(__name__)
 
+BLOCKSIZE = 1 << 24		## bytes read per block from dmp files
+## taxid | name [| unique name | name class] with an optional trailing separator
+NAMES_ROW = re.compile(rb"^(\d+)\t\|\t([^\t\r\n]*)(?:\t\|\t[^\t\r\n]*\t\|\t([^\t\r\n|]*))?[\t|\r]*$", re.M)
+SCIENTIFIC = (b"scientific name", b"")
+## child | parent | rank, remaining columns are ignored
+NODES_ROW = re.compile(rb"^(\d+)\t\|\t(\d+)\t\|\t([^\t\r\n|]*)", re.M)
+## accession | accession.version | taxid, remaining columns are ignored
+ACCESSION_ROW = re.compile(rb"^[^\t\n]*\t([^\t\r\n]+)\t([^\t\r\n]+)", re.M)
+
+## sequence id of a FASTA header, the id ends at the first space as in the genome file headers
+HEADER_ID = re.compile(rb"\n>([^ \r\n]*)")
+FIRST_HEADER_ID = re.compile(rb">([^ \r\n]*)")
+PROGRESS = 1 << 30		## bytes between progress messages when scanning nt files
+
+PROBE_THREADS = 16		## threads used to list the genomes folder and read FASTA headers
+HEADER_BLOCK = 1 << 16	## bytes read per step when looking for the first FASTA header
+
+_accessions = set()		## sequence ids searched for by accession parser workers
+
+def init_accession_worker(accessions):
+	'''Pool initializer, the set of searched sequence ids is sent once to each worker'''
+	global _accessions
+	_accessions = accessions
+
+class SequenceIds(object):
+	"""Map from sequence id to genome id. Ids of nt files are their own genome id, they are kept in a
+		set of bytes without a decoded copy per id which keeps the memory use of large nt files down."""
+	def __init__(self):
+		super(SequenceIds, self).__init__()
+		self.genomes = {}
+		self.nt = set()
+
+	def __setitem__(self, seqid, genome):
+		self.genomes[seqid] = genome
+
+	def __getitem__(self, seqid):
+		try:
+			return self.genomes[seqid]
+		except KeyError:
+			if seqid in self.nt:
+				return seqid.decode("utf-8")
+			raise
+
+	def __contains__(self, seqid):
+		return seqid in self.genomes or seqid in self.nt
+
+	def __iter__(self):
+		yield from self.genomes
+		for seqid in self.nt:
+			if seqid not in self.genomes:
+				yield seqid
+
+	def __len__(self):
+		return len(self.genomes) + len(self.nt - self.genomes.keys())
+
+	def add_nt(self, seqids):
+		self.nt.update(seqids)
+
+def scan_headers(buffer, start=0, end=None):
+	'''Find the sequence ids of all FASTA headers in buffer[start:end], start must be the beginning of a line.
+		The search jumps between newline + > markers and never touches sequence lines in Python
+
+	------
+	Returns
+		list - sequence ids (bytes)
+	'''
+	if end is None:
+		end = len(buffer)
+	first = FIRST_HEADER_ID.match(buffer, start, end)
+	seqids = HEADER_ID.findall(buffer, start, end)
+	if first:
+		seqids.insert(0,first.group(1))
+	return seqids
+
+def scan_directory(path, file_endings=(".fna",".fa",".fasta")):
+	'''List one directory of the genomes folder
+
+	------
+	Returns
+		list - (path, filename, size, mtime_ns) of sequence files
+		list - sub directories
+	'''
+	files,dirs = [],[]
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=True):
+				dirs.append(entry.path)
+			elif entry.name.strip(".gz").endswith(file_endings):
+				stat = entry.stat(follow_symlinks=True)
+				files.append((entry.path,entry.name,stat.st_size,stat.st_mtime_ns))
+	return files,dirs
+
+def read_header(path, size=HEADER_BLOCK):
+	'''Read the first line of a (gzipped) FASTA file, only the first block(s) of the file are read and decompressed
+
+	------
+	Returns
+		bytes - first line of the file
+	'''
+	with open(path,"rb") as f:
+		data = f.read(size)
+		if data[:2] == b"\x1f\x8b":
+			stream = zlib.decompressobj(16+zlib.MAX_WBITS)
+			text = stream.decompress(data)
+			while b"\n" not in text and not stream.eof:
+				data = f.read(size)
+				if not data:
+					break
+				text += stream.decompress(data)
+		else:
+			text = data
+			while b"\n" not in text:
+				data = f.read(size)
+				if not data:
+					break
+				text += data
+	return text.split(b"\n",1)[0]
+
+def match_accessions(block, accessions=None):
+	'''Parse a block of accession2taxid rows
+
+	------
+	Returns
+		list - (accession.version, taxid) of rows where the accession is in accessions
+	'''
+	if accessions is None:
+		accessions = _accessions
+	return [(accession,taxid) for accession,taxid in ACCESSION_ROW.findall(block) if accession in accessions]
+
 class ReadTaxonomyNCBI(ReadTaxonomy):
 	"""docstring for ReadTaxonomyNCBI."""
+	index_names = False		## NCBI names are not unique, records refer to nodes by taxid
 	def __init__(self, taxonomy_file=False, database=False,**kwargs):
 		super(ReadTaxonomyNCBI, self).__init__(database=database)
 		self.taxonomy_file = taxonomy_file
@@ -22,6 +160,9 @@ class ReadTaxonomyNCBI(ReadTaxonomy):
 		self.ids = 0
 		self.accessionfile = False
 		self.force_multisource = kwargs["force_multisource"]
+		self.processes = kwargs.get("processes") or 1
+		self.accession_index = kwargs.get("accession_index")
+		self.header_cache = kwargs.get("header_cache")		## optional header cache file (absolute path, size, mtime_ns, sequence id)
 
 	def write_missing(self,missing):
 		'''Write missing genomes to file'''
@@ -33,125 +174,300 @@ class ReadTaxonomyNCBI(ReadTaxonomy):
 	def set_accession_file(self,file):
 		self.accessionfile = file
 
-	def parse_taxonomy(self,treefile=False):
-		'''Parse taxonomy information'''
+	def records(self):
+		'''Read the names and nodes dmp files
+
+		------
+		Returns
+			generator - normalized taxonomy records
+		'''
 		if hasattr(self, "names_dmp"):
 			logger.info("Parse names file {}".format(self.names_dmp))
-			self.read_names(self.names_dmp)
-			self.length = self.database.num_rows("nodes")
+			yield from self.read_names(self.names_dmp)
 		if self.taxonomy_file:
 			logger.info("Parse nodes file {}".format(self.taxonomy_file))
-			self.read_nodes(self.taxonomy_file)
-			self.ids = self.database.num_rows("tree")
+			yield from self.read_nodes(self.taxonomy_file)
+
+	def read_blocks(self, path, size=BLOCKSIZE):
+		'''Read a (gzipped) file in binary blocks that always end on a full line, gzipped files are
+			decompressed by a pigz or gzip process when available so that decompression runs in parallel to parsing
+
+		------
+		Returns
+			generator - blocks of complete lines (bytes)
+		'''
+		proc = False
+		if path.endswith(".gz"):
+			exe = shutil.which("pigz") or shutil.which("gzip")
+			if exe:
+				logger.debug("Decompress {path} using {exe}".format(path=path,exe=exe))
+				proc = subprocess.Popen([exe,"-dc",path],stdout=subprocess.PIPE)
+				_file = proc.stdout
+			else:
+				_file = zopen(path, "rb")
+		else:
+			_file = open(path, "rb")
+		rest = b""
+		complete = False
+		try:
+			while True:
+				block = _file.read(size)
+				if not block:
+					complete = True
+					break
+				block = rest + block
+				end = block.rfind(b"\n")+1
+				rest = block[end:]
+				yield block[:end]
+		finally:
+			_file.close()
+			if proc:
+				proc.wait()
+		if complete and proc and proc.returncode != 0:
+			raise zlib.error("{exe} exited with status {status} on {path}".format(exe=exe,status=proc.returncode,path=path))
+		if rest:
+			yield rest
 
 	def read_nodes(self, taxfile):
-		'''Read NCBI node file and store a dictionary with names in object'''
-		with open(taxfile, "r") as _taxfile:
-			for taxonomy_row in _taxfile:
-				data = taxonomy_row.strip().split("\t|\t")
-				child,parent,rank = data[0],data[1],data[2]
-				if rank == "None" or rank == None:
-					rank = "no rank"
-				if rank not in self.rank:
-					self.add_rank(rank)
-				lev = self.rank[rank]
-				self.database.add_link(child=data[0],parent=data[1],rank=lev)
-			self.database.commit()
-		return
+		'''Read a NCBI node file
+
+		------
+		Returns
+			generator - Rank records and a Block of Link rows per block of the file
+		'''
+		ranks = {}
+		for block in self.read_blocks(taxfile):
+			links = NODES_ROW.findall(block)
+			## Translate new ranks once per block instead of once per row, in order of appearance
+			for rank in dict.fromkeys(rank for child,parent,rank in links):
+				if rank in ranks:
+					continue
+				name = rank.decode("utf-8")
+				if name == "None":
+					name = "no rank"
+				ranks[rank] = name
+				yield Rank(name)
+			yield Block(Link,[(int(parent),int(child),ranks[rank]) for child,parent,rank in links])
 
 	def read_names(self, taxfile):
-		'''Read NCBI node file and store a dictionary with nodes in object'''
-		with open(taxfile, "r") as _taxfile:
-			for taxonomy_row in _taxfile:
-				data = taxonomy_row.strip().split("\t|\t")
-				taxid = data[0]
-				name = data[1]
-				_type = False
-				if len(data) > 3:
-					_type = data[3].rstrip("|\t")
-				if _type == "scientific name" or not _type:
-					self.add_node(name, id=taxid)
-			self.database.commit()
-		return
+		'''Read a NCBI names file, rows without a name class are kept
 
-	def parse_genebank_file(self,filepath,filename):
+		------
+		Returns
+			generator - a Block of Node rows (scientific names) per block of the file
+		'''
+		for block in self.read_blocks(taxfile):
+			yield Block(Node,[(name.decode("utf-8"),int(taxid)) for taxid,name,_type in NAMES_ROW.findall(block) if _type in SCIENTIFIC])
+
+	def parse_genebank_file(self,filepath,filename,refseqid=False):
 		logger.debug("Parse file {filename}".format(filename=filename))
 		genebankid = filename.split("_",2)
 		genebankid = genebankid[0]+"_"+genebankid[1]
-		f = zopen(filepath,"r")
-		refseqid = f.readline().split(b" ")[0].lstrip(b">")
-		f.close()
+		if not refseqid:
+			refseqid = read_header(filepath).split(b" ")[0].lstrip(b">").rstrip()
 		self.refseqid_to_GCF[refseqid] = genebankid
 		return
 
+	def read_header_cache(self, path):
+		'''Read the header cache file, a missing or unreadable cache is treated as empty
+
+		------
+		Returns
+			dict - absolute path: (size, mtime_ns, sequence id)
+		'''
+		cache = {}
+		try:
+			with open(path,"rb") as f:
+				for row in f:
+					filepath,size,mtime,refseqid = row.rstrip(b"\n").split(b"\t")
+					cache[os.fsdecode(filepath)] = (int(size),int(mtime),refseqid)
+		except FileNotFoundError:
+			pass
+		except (OSError,ValueError) as e:
+			logger.warning("Header cache {path} could not be read, all headers are read again ({e})".format(path=path,e=e))
+			cache = {}
+		return cache
+
+	def write_header_cache(self, path, cache):
+		'''Write the header cache file, a failed write only gives a warning'''
+		try:
+			with open(path+".tmp","wb") as f:
+				for filepath,(size,mtime,refseqid) in sorted(cache.items()):
+					f.write(b"\t".join([os.fsencode(filepath),str(size).encode(),str(mtime).encode(),refseqid])+b"\n")
+			os.replace(path+".tmp",path)
+		except OSError as e:
+			logger.warning("Header cache could not be written to {path} ({e})".format(path=path,e=e))
+			try:
+				os.remove(path+".tmp")
+			except OSError:
+				pass
+
+	def walk_genomes(self, genomes_path, executor):
+		'''Walk the genomes folder, every directory is listed by a task on the thread pool
+
+		------
+		Returns
+			list - (path, filename, size, mtime_ns) of all sequence files sorted on path
+		'''
+		files = []
+		pending = {executor.submit(scan_directory,genomes_path)}
+		while pending:
+			done,pending = wait(pending,return_when=FIRST_COMPLETED)
+			for future in done:
+				_files,dirs = future.result()
+				files += _files
+				pending |= {executor.submit(scan_directory,path) for path in dirs}
+		return sorted(files)
+
+	def probe_headers(self, genomes_path):
+		'''List the genomes folder and read the first FASTA header of all genome files on a bounded thread pool,
+			with a header cache (--header_cache) headers of files with unchanged size and mtime are taken from the cache
+
+		------
+		Returns
+			list - (path, filename, sequence id) for genome files, sequence id is False for nt files
+		'''
+		cache = {}
+		if self.header_cache:
+			cache = self.read_header_cache(self.header_cache)
+		updated = {}
+		with ThreadPoolExecutor(max_workers=PROBE_THREADS) as executor:
+			files = self.walk_genomes(genomes_path,executor)
+			probes = {}
+			for filepath,filename,size,mtime in files:
+				if filename.startswith("nt") or self.force_multisource:
+					if not (filename.startswith("GC") and filename.rstrip(".gz").endswith(".fna")):
+						continue
+				abspath = os.path.abspath(filepath)
+				cached = cache.get(abspath)
+				if cached and cached[:2] == (size,mtime):
+					updated[abspath] = cached
+				else:
+					probes[abspath] = (size,mtime,executor.submit(read_header,filepath))
+			for abspath,(size,mtime,future) in probes.items():
+				refseqid = future.result().split(b" ")[0].lstrip(b">").rstrip()
+				updated[abspath] = (size,mtime,refseqid)
+		logger.info("Genome headers read: {n}, from cache: {c}".format(n=len(probes),c=len(updated)-len(probes)))
+		if self.header_cache and (probes or len(updated) != len(cache)):
+			self.write_header_cache(self.header_cache,updated)
+		return [(filepath,filename,updated.get(os.path.abspath(filepath),(0,0,False))[2]) for filepath,filename,size,mtime in files]
+
 	def parse_nt_file(self,filepath,filename):
-		'''Parse large file with all nt entries'''
+		'''Parse large file with all nt entries, only the header ids are kept. Uncompressed files are
+			memory mapped, gzipped files are decompressed in blocks (see read_blocks)'''
 		logger.info("Processing {file}".format(file=filename))
-		with zopen(filepath,"r") as f:
-			for row in f:
-				if row.startswith(b">"):
-					seqid = row.split(b" ")[0].lstrip(b">")
-					self.refseqid_to_GCF[seqid] = seqid.decode("utf-8")
-					#self.database.add_genome(genome=seqid,_id=taxid.decode("utf-8"),reference="nt")
+		found = len(self.refseqid_to_GCF.nt)
+		if filepath.endswith(".gz"):
+			blocks = ((block,0,len(block)) for block in self.read_blocks(filepath))
+			for nbytes,seqids in self._scan_blocks(blocks):
+				self.refseqid_to_GCF.add_nt(seqids)
+		elif os.path.getsize(filepath) > 0:
+			with open(filepath,"rb") as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+				for nbytes,seqids in self._scan_blocks(self._mmap_windows(mm)):
+					self.refseqid_to_GCF.add_nt(seqids)
+		logger.info("{file}: {n} sequence ids".format(file=filename,n=len(self.refseqid_to_GCF.nt)-found))
 		return
 
+	def _mmap_windows(self, mm, size=BLOCKSIZE):
+		'''Split a memory mapped file in windows (mm, start, end) that end before a newline'''
+		start = 0
+		while start < len(mm):
+			end = mm.find(b"\n", min(start+size,len(mm)))
+			if end < 0:
+				end = len(mm)
+			yield mm,start,end
+			start = end
+
+	def _scan_blocks(self, blocks):
+		'''Scan (buffer, start, end) blocks for header ids and report progress in bytes
+
+		------
+		Returns
+			generator - (bytes scanned, sequence ids) per block
+		'''
+		scanned = 0
+		report = PROGRESS
+		for buffer,start,end in blocks:
+			scanned += end-start
+			if scanned >= report:
+				logger.info("{n} MB scanned".format(n=scanned >> 20))
+				report += PROGRESS
+			yield scanned,scan_headers(buffer,start,end)
+
+	def accession_blocks(self, annotation_file):
+		'''Blocks of an accession2taxid file without the header line'''
+		blocks = self.read_blocks(annotation_file)
+		header = next(blocks,b"")
+		yield header[header.find(b"\n")+1:]
+		yield from blocks
+
+	def read_accessions(self, annotation_file):
+		'''Parse an accession2taxid file, blocks are parsed by a pool of workers (processes) and results
+			are returned in file order. If an accession index is set the accessions are looked up in the
+			index instead, the index is (re)built when it does not match the annotation file
+
+		------
+		Returns
+			generator - (accession.version, taxid) for sequence ids found in the genomes folder
+		'''
+		if self.accession_index:
+			index = AccessionIndex(self.accession_index)
+			if not index.is_current(annotation_file):
+				index.build(annotation_file,(row for block in self.accession_blocks(annotation_file) for row in ACCESSION_ROW.findall(block)))
+			else:
+				logger.info("Use accession index {path}".format(path=self.accession_index))
+			yield from index.lookup(self.refseqid_to_GCF)
+			return
+		blocks = self.accession_blocks(annotation_file)
+		if self.processes < 2:
+			accessions = self.refseqid_to_GCF
+			for block in blocks:
+				yield from match_accessions(block,accessions)
+			return
+		with Pool(self.processes,initializer=init_accession_worker,initargs=(set(self.refseqid_to_GCF),)) as pool:
+			for matches in imap_bounded(pool,match_accessions,blocks,2*self.processes):
+				yield from matches
+
+	def _parse_accession2taxid(self,annotation_file,annotated_genome,reference):
+		'''Generator of (genome, taxid, reference) for sequence ids found in the genomes folder'''
+		for refseqid,taxid in self.read_accessions(annotation_file):
+			annotated_genome.add(refseqid)
+			yield self.refseqid_to_GCF[refseqid],taxid.decode("utf-8"),reference
+
 	def parse_genomeid2taxid(self, genomes_path,annotation_file,reference="refseq"):
 		'''To allow NCBI databases to be build from scratch the sequences names needs to be stored in the database,
 			this function parses the accession2taxid file from NCBI to speed up the function and reduce the amount
 			of stored datata only sequences in input genomes_path will be fetched
 		'''
-		file_endings = (".fna",".fa",".fasta")
 		logger.info("Parsing ncbi accession2taxid, genome_path: {dir}".format(dir = genomes_path))
-		self.refseqid_to_GCF = {}
-		for root, dirs, files in os.walk(genomes_path,followlinks=True):
-			for filename in files:
-				if filename.strip(".gz").endswith(file_endings):
-					filepath = os.path.join(root, filename)
-					if filename.startswith("GC") and filename.rstrip(".gz").endswith(".fna"):
-						self.parse_genebank_file(filepath,filename)
-					elif filename.startswith("nt") or self.force_multisource:
-						if self.force_multisource:
-							self.parse_nt_file(filepath,filename)
-						else:
-							reference="nt" 
-							if filename.endswith(".gz"): 
-								compressed=True 
-							else: 
-								compressed=False
-							stats = os.stat(filepath)
-							logger.info("Parsing nt archive, filesize: {filesize}Mb, compressed: {compressed}".format(compressed=compressed,filesize=(stats.st_size / (1024 * 1024))))
-							self.parse_nt_file(filepath,filename)
-					else:
-						self.parse_genebank_file(filepath,filename)
+		self.refseqid_to_GCF = SequenceIds()
+		for filepath,filename,refseqid in self.probe_headers(genomes_path):
+			if filename.startswith("GC") and filename.rstrip(".gz").endswith(".fna"):
+				self.parse_genebank_file(filepath,filename,refseqid)
+			elif filename.startswith("nt") or self.force_multisource:
+				if self.force_multisource:
+					self.parse_nt_file(filepath,filename)
+				else:
+					reference="nt" 
+					if filename.endswith(".gz"): 
+						compressed=True 
+					else: 
+						compressed=False
+					stats = os.stat(filepath)
+					logger.info("Parsing nt archive, filesize: {filesize}Mb, compressed: {compressed}".format(compressed=compressed,filesize=(stats.st_size / (1024 * 1024))))
+					self.parse_nt_file(filepath,filename)
+			else:
+				self.parse_genebank_file(filepath,filename,refseqid)
 		logger.info("genomes folder read, {n} sequence files found".format(n=len(self.refseqid_to_GCF)))
 		if not annotation_file.endswith("accession2taxid.gz"):
 			raise TypeError("The supplied annotation file does not seem to be the ncbi nucl_gb.accession2taxid.gz")
 		annotated_genome = set()
 		try:
-			with zopen(annotation_file,"r") as f:
-				headers = f.readline().split(b"\t")
-				for row in f:
-					if row.strip() != "": ## If there are trailing empty lines in the file
-						if len(row.split(b"\t")) > 2:
-							try:
-								refseqid,taxid = row.split(b"\t")[1:3]
-							except:
-								logger.info(row)
-								logger.info(row.split(b"\t"))
-								if len(annotated_genome) > 0:
-									logger.info("Potential error in last row?")
-								else:
-									logger.info("Error on first line in annotation file, check format!")
-							try:
-								genebankid = self.refseqid_to_GCF[refseqid]
-								self.database.add_genome(genome=genebankid,_id=taxid.decode("utf-8"),reference=reference)
-								annotated_genome.add(refseqid)
-							except KeyError:
-								pass
-				self.database.commit()
+			inserted,ignored = self.database.bulk_add_genomes(self._parse_accession2taxid(annotation_file,annotated_genome,reference))
+			logger.info("Genomes added: {inserted}, ignored: {ignored}".format(inserted=inserted,ignored=ignored))
 		except zlib.error as e:
 			logger.info("Error in annotation file {e}".format(e=e))
-		missing = set(self.refseqid_to_GCF.keys()) - annotated_genome
+		missing = set(self.refseqid_to_GCF) - annotated_genome
 		missing = [self.refseqid_to_GCF[m] for m in missing] ## Translate to GCF ids
 		if logging.root.level <=20: ## Equal to --verbose
 			logger.info("Printing non added genome id´s (GCF) to ./FlexTaxD.not_added")
@@ -4,17 +4,80 @@
 Read QIIME formatted taxonomy files and holds a dictionary with taxonomy tree and name translation
 '''
 
-from .ReadTaxonomy import ReadTaxonomy
+from .ReadTaxonomy import ReadTaxonomy,Node,Link,Rank,Genome,Block,CHUNKSIZE
 from .database.DatabaseConnection import DatabaseFunctions
+from .functions import imap_bounded
+from multiprocessing import Pool
+import os
 import logging
 logger = logging.getLogger(__name__)
 
+SHARDSIZE = 1 << 25		## bytes per shard when taxonomy files are parsed by several processes
+
+def parse_rows(rows,reference=False):
+	'''Parse QIIME formatted rows (genome_id	lineage)
+
+	------
+	Returns
+		generator - normalized (genome_id, reference, lineage) records
+	'''
+	refDict = {"RS":"refseq","GB":"genbank"}  ## Refdict for GTDB formatted sources
+	for row in rows:
+		if row.strip() != "":  ## If there are trailing empty lines in the file
+			data = row.strip().split("\t")
+			_reference = reference
+			if data[0].startswith(("RS","GB")):
+				'''GTDB genome annotations contain one additional annotation to their genome names eg. RS_, this function removes this'''
+				_reference,genome_id = data[0].split("_",1)   ## Genome ID
+				genome_id = genome_id.strip()
+				if not reference:
+					_reference = refDict[_reference]
+			else:
+				genome_id = data[0].strip()
+			yield genome_id,_reference,data[-1]
+
+def split_shards(path,size=SHARDSIZE):
+	'''Split a file into byte ranges of about size bytes that start at the beginning of a row
+
+	------
+	Returns
+		list - (path, start, end)
+	'''
+	filesize = os.path.getsize(path)
+	bounds = [0]
+	with open(path,"rb") as f:
+		while bounds[-1] + size < filesize:
+			f.seek(bounds[-1] + size)
+			f.readline()  ## Move to the start of the next row
+			if f.tell() >= filesize:
+				break
+			bounds.append(f.tell())
+	bounds.append(filesize)
+	return [(path,start,end) for start,end in zip(bounds,bounds[1:])]
+
+def parse_shard(shard):
+	'''Parse a shard (path, start, end, reference) of a QIIME file, run by the parser processes
+
+	------
+	Returns
+		list - normalized (genome_id, reference, lineage) records
+	'''
+	path,start,end,reference = shard
+	with open(path,"rb") as f:
+		f.seek(start)
+		rows = f.read(end-start).decode("utf-8").split("\n")
+	return list(parse_rows(rows,reference))
+
 class ReadTaxonomyQIIME(ReadTaxonomy):
 	"""docstring for ReadTaxonomyQIIME."""
+	multiple_files = True
 	def __init__(self, taxonomy_file=False, names_dmp=False, database=False, verbose=False, taxid_base=1,**kwargs):
 		super(ReadTaxonomyQIIME, self).__init__(taxonomy_file=taxonomy_file, database=database,verbose=verbose,**kwargs)
 		#self.database = DatabaseFunctions(database,verbose=verbose)  # Not nessesary opens in parent class
 		self.input = taxonomy_file
+		if not isinstance(taxonomy_file,(list,tuple)):
+			self.input = [taxonomy_file]
+		self.processes = kwargs.get("processes") or 1
 		self.names = {}
 		self.taxid_base = taxid_base
 		self.taxonomy = {}
@@ -56,37 +119,56 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 		self.add_link(child=oth_id, parent=self.root,rank="n")
 		self.add_link(child=unc_id, parent=self.root, rank="n")
 
-	def parse_taxonomy(self):
-		'''Parse taxonomy information'''
-		self.qiime_to_tree()
-
-	def parse_tree(self,tree,current_i=0):
-		'''The taxonomy tree does not exist in the standard nomenclature, add a new tree'''
-		### Add parent description if not exist
-		level,description = self.parse_description(tree,current_i)
-		if description.strip() == "":
-			return False
-		if level not in self.taxonomy:
-			self.add_rank(level,qiime=True)
-		if current_i == len(tree)-1:
-			'''Top parent reached return top parent id'''
-			try:
-				return self.taxonomy[description]
-			except KeyError:
-				node_i = self.add_node(description)
-			return node_i
-		parent_i = self.parse_tree(tree,current_i+1)
+	def parse_lineage(self,lineage):
+		'''The taxonomy tree does not exist in the standard nomenclature, add a new tree.
+			The lineage (d__;p__;...;s__) is walked from the lowest level up until a level is
+			found in the lineage cache, missing nodes are then added from the top down.
+			Every resolved prefix of the lineage is cached, a repeated lineage costs a single lookup.
+			Rows of new ranks, nodes and links (in Rank, Node and Link field order) are collected in self.ranks,
+			self.nodes and self.links, self.new_names holds the names of collected nodes that are not loaded yet
+
+		------
+		Returns
+			str - node name of the lowest level (False if the lineage could not be parsed)
+		'''
 		try:
-			'''If parent is already in the database return parent ID'''
-			return self.taxonomy[description]
+			return self.lineage_cache[lineage]
 		except KeyError:
-			''' Add current node to names file '''
-			node_i = self.add_node(description)
-
-		'''When all parents exist add current relation to tree file'''
-		self.add_link(node_i,parent_i,rank=level)
-		'''return new tax_i'''
-		return node_i
+			pass
+		tree = list(reversed(lineage.split(";")))
+		pending = []
+		for current_i in range(len(tree)):
+			prefix = ";".join(reversed(tree[current_i:]))
+			try:
+				parent = self.lineage_cache[prefix]
+				break
+			except KeyError:
+				pass
+			level,description = self.parse_description(tree,current_i)
+			if description.strip() == "":
+				parent = False
+				self.lineage_cache[prefix] = parent
+				break
+			if level not in self.rank:
+				self.ranks.append((level,self.levelDict.get(level)))
+			if current_i == len(tree)-1:
+				'''Top parent reached, top parent node'''
+				if description not in self.taxonomy and description not in self.new_names:
+					self.nodes.append((description,None))
+					self.new_names.add(description)
+				parent = description
+				self.lineage_cache[prefix] = parent
+				break
+			pending.append((prefix,level,description))
+		'''When all parents exist add the remaining nodes and their relations to the tree'''
+		for prefix,level,description in reversed(pending):
+			if description not in self.taxonomy and description not in self.new_names:
+				self.nodes.append((description,None))
+				self.links.append((parent,description,level))
+				self.new_names.add(description)
+			self.lineage_cache[prefix] = description
+			parent = description
+		return parent
 
 	def parse_description(self,tree,current_i):
 		'''Retrieve node description from QIIME formatted tree'''
@@ -98,48 +180,64 @@ class ReadTaxonomyQIIME(ReadTaxonomy):
 		return level,description
 
 
-	def qiime_to_tree(self, sep="\t",reference=False):
-		'''Read the qiime format file and parse out the relation tree (nodes.dmp)'''
-		self.sep = sep
-		self.tree = set()
+	def read_records(self,reference=False):
+		'''Read all input files in order, with more than one process the files are split in shards
+			that are parsed in parallel and collected in input order
+
+		------
+		Returns
+			generator - normalized (genome_id, reference, lineage) records
+		'''
+		if self.processes < 2:
+			for path in self.input:
+				logger.info("Parse {path}".format(path=path))
+				with open(path) as f:
+					yield from parse_rows(f,reference)
+			return
+		shards = [shard+(reference,) for path in self.input for shard in split_shards(path)]
+		logger.info("Parse {n} shards of {files} file(s) using {processes} processes".format(n=len(shards),files=len(self.input),processes=self.processes))
+		with Pool(self.processes) as pool:
+			for records in imap_bounded(pool,parse_shard,shards,2*self.processes):
+				yield from records
+
+	def records(self,reference=False):
+		'''Read the qiime format file(s) and parse out the relation tree (nodes.dmp). Rows are parsed
+			by the parser processes when processes > 1, node ids are assigned by the loader in this process
+
+		------
+		Returns
+			generator - Blocks of normalized taxonomy records
+		'''
 		self.missed = 0
-		self.errors = 0
-		self.added = 0
-		_ref = reference
-		refDict = {"RS":"refseq","GB":"genbank"}  ## Refdict for GTDB formatted sources
-		taxid_start = self.taxid_base
-		with open(self.input) as f:
-			'''Each row defines a genome annotation file connected to a tree level'''
-			for row in f:
-				if row.strip() != "":  ## If there are trailing empty lines in the file
-					data = row.strip().split("\t")
-					try:
-						if data[0].startswith(("RS","GB")):
-							'''GTDB genome annotations contain one additional annotation to their genome names eg. RS_, this function removes this'''
-							reference,genome_id = data[0].split("_",1)   ## Genome ID
-							genome_id = genome_id.strip()
-							if not _ref:
-								reference = refDict[reference]
-						else:
-							genome_id = data[0].strip()
-							'''Greengenes adaption, empty levels'''
-
-						#print(genome_id)
-					except IndexError:
-						logger.debug("Row {row} could not be parsed".format(row=data))
-						self.errors +=1
-					### Walk through tree and make sure all nodes back to root are annotated!
-					taxonomy = list(reversed(data[-1].split(";")))
-					taxonomy_i = self.parse_tree(taxonomy)
-					if taxonomy_i:
-						test = self.database.add_genome(genome=genome_id,_id=taxonomy_i,reference=reference)
-						if not str(test).startswith("UNIQUE"):
-							self.added +=1
-					else:
-						logger.debug("Warning taxonomy: {taxonomy} could not be parsed!!")
-						self.missed +=1
-		self.database.commit()
-		self.length = self.taxid_base - taxid_start
-		logger.info("Genomes added to database: {genomes}".format(genomes=self.added))
-		logger.debug("Genomes not added to database {missed} errors {errors}".format(missed=self.missed,errors=self.errors))
-		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
+		self.lineage_cache = {}
+		self.ranks,self.nodes,self.links = [],[],[]
+		self.new_names = set()
+		genomes = []
+		'''Each row defines a genome annotation file connected to a tree level'''
+		for genome_id,reference,lineage in self.read_records(reference):
+			### Walk through tree and make sure all nodes back to root are annotated!
+			node = self.parse_lineage(lineage)
+			if node:
+				genomes.append((genome_id,node,reference))
+			else:
+				logger.debug("Warning taxonomy: {taxonomy} could not be parsed!!")
+				self.missed +=1
+			if len(self.nodes) + len(genomes) >= CHUNKSIZE:
+				yield from self.collected(genomes)
+				genomes = []
+		yield from self.collected(genomes)
+		logger.debug("Genomes not added to database {missed}".format(missed=self.missed))
+
+	def collected(self,genomes):
+		'''Hand over the collected records, nodes are loaded before the genomes that refer to them
+
+		------
+		Returns
+			generator - Blocks of Rank, Node, Link and Genome records
+		'''
+		yield Block(Rank,self.ranks)
+		yield Block(Node,self.nodes)
+		yield Block(Link,self.links)
+		yield Block(Genome,genomes)
+		self.ranks,self.nodes,self.links = [],[],[]
+		self.new_names = set()
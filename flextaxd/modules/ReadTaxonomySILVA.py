@@ -13,7 +13,7 @@ __email__ = "bioinformatics@foi.se"
 __date__ = "2020-01-17"
 __status__ = "Production"
 
-from .ReadTaxonomy import ReadTaxonomy
+from .ReadTaxonomy import ReadTaxonomy,Node,Link,Rank,Block
 import logging
 logger = logging.getLogger(__name__)
 
@@ -26,6 +26,7 @@ class ImportFormatError(Exception):
 
 class ReadTaxonomySILVA(ReadTaxonomy):
 	"""docstring for ReadTaxonomySILVA."""
+	index_names = False		## SILVA names are not unique (e.g. uncultured), parents are resolved by their lineage
 	def __init__(self, taxonomy_file=False, database=".silva",  taxid_base=1,root_name="root",rank="family", verbose=False,**kwargs):
 		super(ReadTaxonomySILVA, self).__init__(taxonomy_file=taxonomy_file, database=database,verbose=verbose,**kwargs)
 		self.input = taxonomy_file
@@ -39,29 +40,62 @@ class ReadTaxonomySILVA(ReadTaxonomy):
 	def parse_taxonomy(self):
 		'''Retrieve node description from SILVA formatted tree'''
 		logger.info("Parse SILVA tree file")
+		self.load(self.records())
+		self.taxid_num = self.length
+		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
+
+	def read_rows(self):
+		'''Read all rows of a SILVA taxonomy file (lineage;	taxid	rank)
+
+		------
+		Returns
+			list - (lineage, name, taxid, rank) for every row, lineage is the path of the node itself
+		'''
+		rows = []
 		with self.zopen(self.taxonomy_file,"r") as f:
 			for row in f:
+				if row.strip() == "":
+					continue
 				tree,info = row.strip().rsplit(";",1) ## separate tree from info columns
-				nodes = tree.strip().split(";")  ## get node and all its parents in a list.
+				nodes = [node.strip() for node in tree.split(";")]  ## get node and all its parents in a list.
 				info = info.lstrip("\t")
 				try:
 					taxid,rank,_ = info.split("\t",2)
 				except ValueError:
 					taxid,rank = info.split("\t")
-				child = nodes[-1]  ## get name of child node
-				self.add_rank(rank)
-				'''If the tree was not properly formatted an a parent is missing make sure that function works anyway by adding any parent node above child'''
-				try:
-					pname = nodes[-2].strip()
-					parent_i = self.taxonomy[pname]  ## Check if parent of child node exists
-				except IndexError: ## Should be first row with only one node (parent)
-					child_i = self.add_node(child,id=taxid)
-					self.add_link(child_i,self.root,rank=rank)
-					continue
-				'''Now all parents exists, add new child node and add the link'''
-				child_i = self.add_node(child,id=taxid)
-				self.add_link(child_i,parent_i,rank=rank)
-		self.database.commit()
-		self.length = len(self.taxonomy)                ## Check number of new nodes added
-		self.taxid_num = len(self.taxonomy)
-		logger.info("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
+				rows.append((";".join(nodes),nodes[-1],int(taxid),rank))
+		return rows
+
+	def parent_id(self, lineage, paths):
+		'''Get the taxid of the parent of a node lineage, if the parent row is missing in the file
+			the closest ancestor in the file is used (the root if there is none)
+
+		------
+		Returns
+			int - taxid of the parent
+		'''
+		while ";" in lineage:
+			lineage = lineage.rsplit(";",1)[0]
+			try:
+				return paths[lineage]
+			except KeyError:
+				self.missing += 1
+		return self.root
+
+	def records(self):
+		'''Two pass import of a SILVA taxonomy file, all rows are read first and parents are resolved by
+			their lineage once all nodes are known, so the order of the rows in the file does not matter
+
+		------
+		Returns
+			generator - Blocks of Rank, Node and Link records
+		'''
+		rows = self.read_rows()
+		paths = {lineage: taxid for lineage,name,taxid,rank in rows}
+		self.missing = 0
+		links = [(self.parent_id(lineage,paths),taxid,rank) for lineage,name,taxid,rank in rows]
+		if self.missing > 0:
+			logger.warning("{n} parent levels are missing in the SILVA file, nodes were linked to their closest ancestor".format(n=self.missing))
+		yield Block(Rank,[(rank,None) for rank in dict.fromkeys(rank for lineage,name,taxid,rank in rows)])
+		yield Block(Node,[(name,taxid) for lineage,name,taxid,rank in rows])
+		yield Block(Link,links)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3 -c
+
+'''
+TaxonomyGraph holds a read only snapshot of a FlexTaxD tree in compact arrays. The snapshot is loaded
+with a single scan of the nodes and tree tables and gives constant time parent lookups, lineages,
+subtree iteration, depth and LCA queries without further database calls.
+
+Nodes are stored by position (index), all arrays are indexed by that position
+	taxid		- taxonomy id of each position
+	parent		- position of the parent (-1 for root and nodes without a parent)
+	rank		- rank_i of the link above each node
+	names		- name of each position
+	child_offset,children - children of position i are children[child_offset[i]:child_offset[i+1]]
+'''
+
+from array import array
+from .database.DatabaseConnection import DatabaseFunctions,TreeError
+import logging
+logger = logging.getLogger(__name__)
+
+class TaxonomyGraph(object):
+	"""TaxonomyGraph, array backed in memory snapshot of a FlexTaxD taxonomy tree."""
+	def __init__(self, database=False):
+		super(TaxonomyGraph, self).__init__()
+		self.taxid = array("q")
+		self.parent = array("q")
+		self.rank = array("q")
+		self.names = []
+		self.child_offset = array("q",[0])
+		self.children = array("q")
+		self.index = {}							## taxid to position
+		self.ranks = {}							## rank_i to rank name
+		self.duplicated = set()					## taxids linked to more than one parent, only the first parent is kept
+		self._name_index = False
+		if database:
+			self.load(database)
+
+	def __len__(self):
+		return len(self.taxid)
+
+	def __contains__(self, taxid):
+		return taxid in self.index
+
+	def load(self, database):
+		'''Load the snapshot from a DatabaseFunctions object (or a path to a database)
+
+		------
+		Returns
+			int - number of nodes loaded
+		'''
+		if not isinstance(database, DatabaseFunctions):
+			database = DatabaseFunctions(database)
+		self.ranks = dict(database.query("SELECT rank_i,rank FROM rank").fetchall())
+		QUERY = '''SELECT id,name,parent,rank_i FROM nodes LEFT JOIN tree ON (tree.child = nodes.id) ORDER BY id,parent,rank_i'''
+		logger.debug(QUERY)
+		parents = array("q")
+		for _id,name,parent,rank_i in database.query(QUERY):
+			if len(self.taxid) > 0 and self.taxid[-1] == _id:
+				if parent != _id:
+					self.duplicated.add(_id)
+				continue
+			self.index[_id] = len(self.taxid)
+			self.taxid.append(_id)
+			self.names.append(name)
+			parents.append(-1 if parent is None or parent == _id else parent)
+			self.rank.append(-1 if rank_i is None else rank_i)
+		if len(self.duplicated) > 0:
+			logger.warning("{n} nodes have more than one parent, only the first parent is kept in the graph".format(n=len(self.duplicated)))
+		## Translate parent taxids into positions and count children per position
+		counts = array("q",[0])*(len(self.taxid)+1)
+		for parent in parents:
+			pos = self.index.get(parent,-1)
+			self.parent.append(pos)
+			if pos >= 0:
+				counts[pos+1] += 1
+		for i in range(len(self.taxid)):
+			counts[i+1] += counts[i]
+		self.child_offset = array("q",counts)
+		self.children = array("q",[0])*len(self.taxid)
+		for i,pos in enumerate(self.parent):
+			if pos >= 0:
+				self.children[counts[pos]] = i
+				counts[pos] += 1
+		self.children = self.children[:self.child_offset[-1]]
+		logger.debug("TaxonomyGraph loaded {n} nodes".format(n=len(self.taxid)))
+		return len(self.taxid)
+
+	def _pos(self, taxid):
+		try:
+			return self.index[taxid]
+		except KeyError:
+			raise TreeError("Node {taxid} is not in the taxonomy".format(taxid=taxid))
+
+	def get_id(self, name):
+		'''Get the taxid of a node name, the name index is built on first use'''
+		if not self._name_index:
+			self._name_index = {name:self.taxid[i] for i,name in enumerate(self.names)}
+		return self._name_index[name]
+
+	def get_name(self, taxid):
+		return self.names[self._pos(taxid)]
+
+	def get_rank(self, taxid):
+		return self.ranks.get(self.rank[self._pos(taxid)])
+
+	def get_parent(self, taxid):
+		'''Get the parent of a node
+
+		------
+		Returns
+			int - parent taxid, None for root and nodes without a parent
+		'''
+		pos = self.parent[self._pos(taxid)]
+		if pos < 0:
+			return None
+		return self.taxid[pos]
+
+	def get_children(self, taxid):
+		'''Get the direct children of a node
+
+		------
+		Returns
+			list - child taxids
+		'''
+		pos = self._pos(taxid)
+		return [self.taxid[i] for i in self.children[self.child_offset[pos]:self.child_offset[pos+1]]]
+
+	def _path(self, pos):
+		'''Positions from pos up to the top of the tree, raises TreeError on cycles'''
+		path = [pos]
+		while self.parent[pos] >= 0:
+			pos = self.parent[pos]
+			path.append(pos)
+			if len(path) > len(self.taxid):
+				raise TreeError("cycle found in lineage of {taxid}".format(taxid=self.taxid[path[0]]))
+		return path
+
+	def depth(self, taxid):
+		'''Number of links between the node and the top of the tree (root has depth 0)'''
+		return len(self._path(self._pos(taxid)))-1
+
+	def lineage(self, taxid):
+		'''Get the lineage of a node, ordered from root down to the node itself
+
+		------
+		Returns
+			list - (taxid, rank) for every node on the path from root to taxid
+		'''
+		return [(self.taxid[pos],self.ranks.get(self.rank[pos])) for pos in reversed(self._path(self._pos(taxid)))]
+
+	def subtree(self, taxid, maxdepth=0):
+		'''Iterate over a node and all its descendants (pre order), maxdepth limits the number of levels below the node
+
+		------
+		Returns
+			generator - taxids of the subtree
+		'''
+		if not isinstance(maxdepth, int) or maxdepth < 0:
+			raise TreeError("maxdepth must be a non-negative integer (0 walks the whole subtree), got {maxdepth}".format(maxdepth=maxdepth))
+		stack = [(self._pos(taxid),0)]
+		visited = set()		## stops the walk on cycles that are not connected to root
+		while stack:
+			pos,level = stack.pop()
+			if pos in visited:
+				continue
+			visited.add(pos)
+			yield self.taxid[pos]
+			if maxdepth and level >= maxdepth:
+				continue
+			## Push children in reverse to visit them in ascending order
+			for i in reversed(self.children[self.child_offset[pos]:self.child_offset[pos+1]]):
+				stack.append((i,level+1))
+
+	def lca(self, *taxids):
+		'''Get the lowest common ancestor of one or more nodes
+
+		------
+		Returns
+			int - taxid of the lowest common ancestor, None if the nodes are not in the same tree
+		'''
+		if len(taxids) == 0:
+			raise TreeError("lca requires at least one node")
+		common = None
+		for taxid in taxids:
+			path = self._path(self._pos(taxid))
+			if common is None:
+				common = path[::-1]
+				continue
+			path = path[::-1]
+			i = 0
+			while i < len(common) and i < len(path) and common[i] == path[i]:
+				i += 1
+			common = common[:i]
+			if not common:
+				return None
+		return self.taxid[common[-1]]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3 -c
+
+'''
+TaxonomySnapshot is a binary file with the taxonomy tree of a FlexTaxD database that is memory mapped when
+opened, parent, rank, name and lineage queries are answered directly from the file without parsing it first.
+
+The snapshot holds the same tree as nodes.dmp and names.dmp written by WriteTaxonomy, children with more than one
+parent have a renumbered id for every further link. Nodes are stored by dense position (index) in ascending taxid
+order. All sections start at a multiple of 8 bytes and all numbers are little endian
+	header		- magic, format version, number of nodes and ranks, offset of every section (HEADER)
+	taxid		- int64 taxid of each position, sorted, also the taxid to position table (binary search)
+	parent		- int32 position of the parent (-1 for root and nodes without a parent)
+	rank		- int16 index of the rank in the rank table (-1 if the node has no link)
+	name_offset	- uint64 offsets of the names, the name of position i is names[name_offset[i]:name_offset[i+1]]
+	names		- utf-8 encoded names
+	ranks		- utf-8 encoded rank names separated by newlines
+'''
+
+from .database.DatabaseConnection import TreeError
+from array import array
+from bisect import bisect_left
+import struct
+import mmap
+import sys
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FTDSNAP\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQQQQQQ")  ## magic, version, number of ranks, number of nodes, offsets of taxid, parent, rank, name_offset, names, ranks and end of file
+
+class SnapshotError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def _align(offset):
+	return (offset+7) & ~7
+
+class TaxonomySnapshot(object):
+	"""TaxonomySnapshot, memory mapped read only binary snapshot of a FlexTaxD taxonomy tree."""
+	def __init__(self, path):
+		super(TaxonomySnapshot, self).__init__()
+		if sys.byteorder != "little":
+			raise SnapshotError("Taxonomy snapshots can only be read on little endian machines")
+		self.path = path
+		self.file = open(path,"rb")
+		if os.fstat(self.file.fileno()).st_size < HEADER.size:
+			self.file.close()
+			raise SnapshotError("{path} is not a taxonomy snapshot".format(path=path))
+		self.mm = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+		magic,version,nranks,n,taxid,parent,rank,name_offset,names,ranks,end = HEADER.unpack_from(self.mm,0)
+		if magic != MAGIC:
+			raise SnapshotError("{path} is not a taxonomy snapshot".format(path=path))
+		if version != VERSION:
+			raise SnapshotError("{path} has snapshot format version {version}, version {current} is supported".format(path=path,version=version,current=VERSION))
+		if end != len(self.mm):
+			raise SnapshotError("{path} is truncated".format(path=path))
+		self.view = view = memoryview(self.mm)
+		self.taxid = view[taxid:taxid+8*n].cast("q")
+		self.parent = view[parent:parent+4*n].cast("i")
+		self.rank = view[rank:rank+2*n].cast("h")
+		self.name_offset = view[name_offset:name_offset+8*(n+1)].cast("Q")
+		self.names = view[names:ranks]
+		self.ranks = str(view[ranks:end],"utf-8").split("\n") if nranks else []
+
+	@staticmethod
+	def write(names, links, path):
+		'''Write a snapshot from batches of (taxid, name) and (child, parent, rank) rows, the rows of names.dmp and
+			nodes.dmp as streamed by WriteTaxonomy. Every child is expected once (duplicated children renumbered)
+
+		------
+		Returns
+			int - number of nodes written
+		'''
+		taxids = array("q")
+		name_offset = array("Q",[0])
+		blob = bytearray()
+		for batch in names:
+			for taxid,name in batch:
+				if taxids and taxid <= taxids[-1]:
+					raise SnapshotError("Names must be given in ascending taxid order, {taxid} follows {last}".format(taxid=taxid,last=taxids[-1]))
+				taxids.append(taxid)
+				blob += name.encode("utf-8")
+				name_offset.append(len(blob))
+		n = len(taxids)
+		parent = array("i",[-1])*n
+		rank = array("h",[-1])*n
+		ranks = {}
+		for batch in links:
+			for child,parent_id,rank_name in batch:
+				pos = bisect_left(taxids,child)
+				if pos == n or taxids[pos] != child:
+					continue  ## the child is not a node of the database
+				if parent_id != child:
+					ppos = bisect_left(taxids,parent_id)
+					if ppos < n and taxids[ppos] == parent_id:
+						parent[pos] = ppos
+				rank[pos] = ranks.setdefault(rank_name or "",len(ranks))
+		sections = [
+			taxids,
+			parent,
+			rank,
+			name_offset,
+			bytes(blob),
+			"\n".join(sorted(ranks,key=ranks.get)).encode("utf-8"),
+		]
+		if sys.byteorder != "little":
+			for section in sections[:4]:
+				section.byteswap()
+		## Sections follow the header, each section starts at a multiple of 8 bytes (names and ranks are not padded between them)
+		offsets = []
+		offset = _align(HEADER.size)
+		for i,section in enumerate(sections):
+			offsets.append(offset)
+			size = len(section)*section.itemsize if isinstance(section,array) else len(section)
+			offset += size
+			if i < 3:
+				offset = _align(offset)
+		with open(path,"wb") as snapshot:
+			snapshot.write(HEADER.pack(MAGIC,VERSION,len(ranks),n,*offsets,offset))
+			for start,section in zip(offsets,sections):
+				snapshot.write(b"\0"*(start-snapshot.tell()))
+				snapshot.write(section)
+		logger.info("Taxonomy snapshot {path} written, {n} nodes ({size} bytes)".format(path=path,n=n,size=offset))
+		return n
+
+	def __len__(self):
+		return len(self.taxid)
+
+	def __contains__(self, taxid):
+		pos = bisect_left(self.taxid,taxid)
+		return pos < len(self.taxid) and self.taxid[pos] == taxid
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		'''Release the memory map, values already returned are plain python objects and stay valid'''
+		for view in [self.taxid,self.parent,self.rank,self.name_offset,self.names,self.view]:
+			view.release()
+		self.mm.close()
+		self.file.close()
+
+	def _pos(self, taxid):
+		pos = bisect_left(self.taxid,taxid)
+		if pos == len(self.taxid) or self.taxid[pos] != taxid:
+			raise TreeError("Node {taxid} is not in the taxonomy".format(taxid=taxid))
+		return pos
+
+	def _name(self, pos):
+		return str(self.names[self.name_offset[pos]:self.name_offset[pos+1]],"utf-8")
+
+	def get_name(self, taxid):
+		return self._name(self._pos(taxid))
+
+	def get_rank(self, taxid):
+		rank = self.rank[self._pos(taxid)]
+		if rank < 0:
+			return None
+		return self.ranks[rank]
+
+	def get_parent(self, taxid):
+		'''Get the parent of a node
+
+		------
+		Returns
+			int - parent taxid, None for root and nodes without a parent
+		'''
+		pos = self.parent[self._pos(taxid)]
+		if pos < 0:
+			return None
+		return self.taxid[pos]
+
+	def _path(self, pos):
+		'''Positions from pos up to the top of the tree, raises TreeError on cycles'''
+		path = [pos]
+		while self.parent[pos] >= 0:
+			pos = self.parent[pos]
+			path.append(pos)
+			if len(path) > len(self.taxid):
+				raise TreeError("cycle found in lineage of {taxid}".format(taxid=self.taxid[path[0]]))
+		return path
+
+	def lineage(self, taxid, names=False):
+		'''Get the lineage of a node, ordered from root down to the node itself
+
+		------
+		Returns
+			list - (taxid, rank) for every node on the path from root to taxid, (taxid, rank, name) if names
+		'''
+		path = reversed(self._path(self._pos(taxid)))
+		if names:
+			return [(self.taxid[pos],self.ranks[self.rank[pos]] if self.rank[pos] >= 0 else None,self._name(pos)) for pos in path]
+		return [(self.taxid[pos],self.ranks[self.rank[pos]] if self.rank[pos] >= 0 else None) for pos in path]
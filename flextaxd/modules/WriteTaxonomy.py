@@ -5,25 +5,83 @@ Read NCBI taxonomy dmp files (nodes or names) and holds a dictionary
 '''
 
 from .database.DatabaseConnection import DatabaseFunctions
+from .CompressedOutput import open_output
+from .TaxonomyGraph import TaxonomyGraph
+from .TaxonomySnapshot import TaxonomySnapshot
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue,Full,Empty
+from threading import Event
+from itertools import chain
 import logging
+import os
 logger = logging.getLogger(__name__)
 
+BATCHSIZE = 100000		## rows fetched, formatted and written per batch
+BUFFERSIZE = 1 << 20	## write buffer of output files
+QUEUESIZE = 2			## batches waiting for each writer thread of export
+WAIT = 0.1				## seconds between checks of the cancel event of export while a queue is full or empty
+FLAVOURS = ["kraken2","krakenuniq","bracken","ganon","minimal"]  ## program flavours export can write from one scan
+
+'''Children with more than one parent (duplicated indexes) keep their id in the link with the lowest parent, every further
+	link gets a new id above the largest node id. Links are ordered by (child, parent, rank_i), unique in tree, and not by
+	rowid which VACUUM may change, so that the same tree always gives the same ids. The renumbered links are kept in
+	temp.renumbered (link is the rowid in tree, only used to join within the same run)'''
+RENUMBER = '''SELECT link,(SELECT MAX(id) FROM nodes)+100+ROW_NUMBER() OVER (ORDER BY child,parent,rank_i),child FROM
+	(SELECT tree.rowid AS link,child,parent,rank_i,ROW_NUMBER() OVER (PARTITION BY child ORDER BY parent,rank_i) AS n FROM tree
+		WHERE child IN (SELECT child FROM tree GROUP BY child HAVING count(*) > 1))
+	WHERE n > 1'''  ## Thanks to andrewjmc@github for the duplicated child query, count(*) is answered by the tree_child index
+RENUMBERED_LINKS = '''SELECT coalesce(renumbered.id,tree.child),parent,rank FROM tree JOIN (rank) on rank.rank_i = tree.rank_i
+	LEFT JOIN temp.renumbered ON (renumbered.link = tree.rowid)'''
+RENUMBERED_NAMES = '''SELECT renumbered.id,name FROM temp.renumbered JOIN nodes ON (nodes.id = renumbered.child) ORDER BY renumbered.id'''
+
+def put(queue, item, cancel):
+	'''Put an item on a bounded queue of export, waiting only until cancel is set (another thread failed)
+
+	------
+	Returns
+		boolean - True if the item was queued
+	'''
+	while not cancel.is_set():
+		try:
+			queue.put(item,timeout=WAIT)
+			return True
+		except Full:
+			pass
+	return False
+
+def batches(queue, cancel):
+	'''Iterate over the batches of a queue of export until the end of the table (None) or until cancel is set'''
+	while not cancel.is_set():
+		try:
+			rows = queue.get(timeout=WAIT)
+		except Empty:
+			continue
+		if rows is None:
+			return
+		yield rows
+
+class InputError(Exception):
+	"""Exception raised for errors in the input."""
+	def __init__(self, message):
+		self.message = message
+
 class WriteTaxonomy(object):
 	"""docstring for WriteTaxonomy."""
-	def __init__(self, path, database=".taxonomydb",separator="\t|\t",minimal=False,prefix="names,nodes",desc=False,dbprogram=None,dump_genomes=False,**kwargs):
+	def __init__(self, path, database=".taxonomydb",separator="\t|\t",minimal=False,prefix="names,nodes",desc=False,dbprogram=None,dump_genomes=False,compression=False,threads=1,**kwargs):
 		super(WriteTaxonomy, self).__init__()
 		self.database = DatabaseFunctions(database)
 		logging.debug("Write settings: ")
 		self.path = path.rstrip("/")+"/"
 		logging.debug("Output path: {outdir}".format(outdir=self.path))
 		self.separator = separator
+		self.dump_separator = separator  ## separator as given, self.separator is changed for minimal output
 		logging.debug("Output separator: '{separator}'".format(separator=self.separator))
 		self.prefix = prefix.split(",")
 		logging.debug("Prefix: nodes:{nodes} names:{names} ".format(nodes=self.prefix[1],names=self.prefix[0]))
 		self.dump_descriptions = desc
 		logging.debug("Add descriptions: {desc}".format(desc=self.dump_descriptions))
 		### Allows a minimal output file with only nessesary fields default is NCBI id | name | empty | scientific name
-		self.updated = False
+		self.renumbered = None  ## number of links with a new id (see unique_indexes)
 		self.minimal = minimal
 		if self.minimal:
 			if dbprogram:
@@ -38,23 +96,37 @@ class WriteTaxonomy(object):
 		if self.dbprogram: logging.debug("Output format for program {program}".format(program=self.dbprogram))
 		self.link_order = False ## Default print is NCBI structure with child in the first column
 		logging.debug("NCBI structure (child first): {parent}".format(parent=self.link_order))
+		### Compressed output, the suffix is added to all output files and selects the compression (see CompressedOutput)
+		self.suffix = ""
+		if compression:
+			if compression not in ["gz","bz2","xz"]:
+				raise InputError("Unknown compression {compression}, choose from gz, bz2 or xz".format(compression=compression))
+			self.suffix = "."+compression
+		self.threads = threads  ## gzip output is compressed in parallel when threads > 1
+		logging.debug("Output compression: '{suffix}' threads: {threads}".format(suffix=self.suffix,threads=self.threads))
+
+	def open(self, name):
+		'''Open an output file in the output folder, compressed if a compression was selected'''
+		return open_output('{}{}{}'.format(self.path,name,self.suffix),threads=self.threads,buffering=BUFFERSIZE)
+
+	def write_rows(self, outputfile, batches, sep="\t", end="\n"):
+		'''Write batches of rows, each batch is formatted with str.join and written with one call'''
+		for rows in batches:
+			outputfile.write("".join([sep.join(map(str,row))+end for row in rows]))
 
 	def dump_taxid_map(self):
 		logging.info("Dump taxid maps")
-		with open('{}{}.map'.format(self.path,"seqid2taxid"),"w") as outputfile,open('{}{}.txt'.format(self.path,"prelim_map"),"w") as prelim:
-			genomes = self.get_all('genomes', 'genome,id')
-			for genome in genomes:
-				print(*genome, sep="\t", end="\n", file=outputfile)
-				genome=tuple(["TAXID"]) + genome
-				print(*genome, sep="\t", end="\n", file=prelim)
+		with self.open("seqid2taxid.map") as outputfile,self.open("prelim_map.txt") as prelim:
+			for genomes in self.get_all('genomes', 'genome,id', batches=True):
+				lines = ["{}\t{}\n".format(*genome) for genome in genomes]
+				outputfile.write("".join(lines))
+				prelim.write("".join(["TAXID\t"+line for line in lines]))
 		return
 
 	def dump_genomes(self):
 		'''Write the list of annotated genomes to a file'''
-		with open('{}{}.dmp'.format(self.path,"genomes"),"w") as outputfile:
-			genomes = self.get_all('genomes', 'genome,reference', sort="reference")
-			for genome in genomes:
-				print(*genome, sep="\t", end="\n", file=outputfile)
+		with self.open("genomes.dmp") as outputfile:
+			self.write_rows(outputfile, self.get_all('genomes', 'genome,reference', sort="reference", batches=True))
 		return
 
 	def dump_genome_annotations(self, sort="reference"):
@@ -64,10 +136,8 @@ class WriteTaxonomy(object):
 		if sort:
 			QUERY += " ORDER BY {col} DESC".format(col=sort)
 		logging.debug(QUERY)
-		with open('{}{}.dmp'.format(self.path,"genomes"),"w") as outputfile:
-			genomes = self.database.query(QUERY).fetchall()
-			for genome in genomes:
-				print(*genome, sep="\t", end="\n", file=outputfile)
+		with self.open("genomes.dmp") as outputfile:
+			self.write_rows(outputfile, self.database.iter_batches(QUERY,size=BATCHSIZE))
 		return
 
 	def set_separator(self,sep):
@@ -93,85 +163,306 @@ class WriteTaxonomy(object):
 		logging.debug("Update output prefix nodes:{nodes} names:{names} ".format(nodes=self.prefix[1],names=self.prefix[0]))
 		return self.prefix
 
-	def get_all(self, table, select="*", sort=False):
+	def get_all(self, table, select="*", sort=False, batches=False):
+		'''Get all rows of a table
+
+		------
+		Returns
+			list - rows of the table (generator of lists of rows if batches)
+		'''
 		QUERY = "SELECT {select} FROM {table}".format(select=select, table=table)
 		if sort:
 			QUERY += " ORDER BY {col} DESC".format(col=sort)
 		logging.debug(QUERY)
+		if batches:
+			return self.database.iter_batches(QUERY,size=BATCHSIZE)
 		return self.database.query(QUERY).fetchall()
 
-	def get_links(self, table, select="child,parent,rank"):
+	def get_links(self, table, select="child,parent,rank", batches=False):
+		'''Get all links of the tree with rank names
+
+		------
+		Returns
+			list - links (generator of lists of links if batches)
+		'''
 		QUERY = "SELECT {select} FROM {table} JOIN (rank) on rank.rank_i = tree.rank_i".format(select=select, table=table)
 		logging.debug(QUERY)
+		if batches:
+			return self.database.iter_batches(QUERY,size=BATCHSIZE)
 		return self.database.query(QUERY).fetchall()
 
+	def renumber(self, database, links=False):
+		'''Create temp.renumbered on a connection, from the (link, id, child) rows given or from RENUMBER
+
+		------
+		Returns
+			int - number of renumbered links
+		'''
+		database.conn.execute("DROP TABLE IF EXISTS temp.renumbered")
+		database.conn.execute("CREATE TEMP TABLE renumbered (link INTEGER PRIMARY KEY, id INTEGER, child INTEGER)")
+		if links:
+			database.conn.executemany("INSERT INTO temp.renumbered VALUES (?,?,?)",links)
+		else:
+			database.conn.execute("INSERT INTO temp.renumbered {query}".format(query=RENUMBER))
+		database.commit()
+		return database.fetch_one("SELECT count(*) FROM temp.renumbered")[0]
+
 	def unique_indexes(self):
-		'''Check duplicated indexes and give them unique IDs before print'''
-		QUERY = "SELECT child FROM tree GROUP BY child HAVING count(parent) > 1"  ## Thanks to andrewjmc@github for this suggestion
-		child_w_dpi = self.database.query(QUERY).fetchall()  ## Fetch all conflicting links and give them unique index before printing
-		child_w_dpi = list(*child_w_dpi)
-		lmax = 10000000
-		if len(child_w_dpi) > 0:
-			self.nodeDict = self.database.get_nodes(col=1)
-			lmax = max(self.nodeDict)
-		return lmax,child_w_dpi
+		'''Check duplicated indexes and give them unique IDs before print, the ids are assigned in SQL once per object
+
+		------
+		Returns
+			int - number of links with a new id
+		'''
+		if self.renumbered is None:
+			self.renumbered = self.renumber(self.database)
+			if self.renumbered:
+				logger.info("{n} links of children with more than one parent were given a unique index".format(n=self.renumbered))
+		return self.renumbered
+
+	def line_ends(self, dbprogram, minimal, sep):
+		'''End of the rows in nodes.dmp and names.dmp, the extra columns expected by each program
+
+		------
+		Returns
+			str - end of nodes.dmp rows
+			str - end of names.dmp rows
+		'''
+		## Extra (empty) columns of each nodes row
+		columns = []
+		if dbprogram in ["bracken"]:
+			columns += ["-"]
+		if dbprogram == "kraken2":
+			columns += ["",""] ## Make sure to add enough extra columns so that kraken2 does not trim away nessesary columns
+		if not minimal:
+			columns += [""]
+		nodes_end = "".join([sep+column for column in columns])+"\n"
+		names_end = "\n"
+		if dbprogram in ["krakenuniq","kraken2"]:
+			names_end = "\t|\n"
+		if not minimal:
+			empty = ""
+			if dbprogram == "bracken":
+				empty = "-"
+			names_end = sep+empty+sep+"scientific name"+names_end
+		return nodes_end,names_end
+
+	def snapshot(self, name="taxonomy.snap"):
+		'''Write the tree to a binary snapshot that is memory mapped by TaxonomySnapshot, the snapshot is never compressed
+
+		------
+		Returns
+			str - path of the snapshot
+		'''
+		path = '{}{}'.format(self.path,name)
+		logging.info('Write taxonomy snapshot to: {}'.format(path))
+		## Same rows as nodes() and names(), duplicated children get the same renumbered ids as in the dmp files
+		names = self.get_all('nodes', 'id,name', batches=True)
+		links = self.get_links('tree','child,parent,rank',batches=True)
+		if self.unique_indexes():
+			names = chain(names,self.database.iter_batches(RENUMBERED_NAMES,size=BATCHSIZE))
+			links = self.database.iter_batches(RENUMBERED_LINKS,size=BATCHSIZE)
+		TaxonomySnapshot.write(names,links,path)
+		return path
 
 	def nodes(self):
-		'''Write database tree to nodes.dmp'''
-		logging.info('Write tree to: {}{}.dmp'.format(self.path,self.prefix[1]))
-		child_w_dpi = []
-		checklist = {}
-		with open('{}{}.dmp'.format(self.path,self.prefix[1]),"w") as outputfile:
+		'''Write database tree to nodes.dmp, links are streamed from the database and written in batches'''
+		logging.info('Write tree to: {}{}.dmp{}'.format(self.path,self.prefix[1],self.suffix))
+		sep = self.separator
+		end = self.line_ends(self.dbprogram,self.minimal,sep)[0]
+		with self.open('{}.dmp'.format(self.prefix[1])) as outputfile:
 			## Retrieve all links that exists in the database
+			batches = self.get_links('tree','child,parent,rank',batches=True)
 			if self.dump_descriptions:
-				self.nodeDict = self.database.get_nodes()
-				print("child\tparent\trank", sep=self.separator, end="\n", file=outputfile)
-			else:
-				lmax,child_w_dpi = self.unique_indexes()
-			links = self.get_links('tree','child,parent,rank')
-			for link in links:
-				link = list(link)
-				'''If child with duplicate index, make sure link has unique index, match with node'''
-				if link[0] in child_w_dpi:
-					try:
-						checklist[link[0]] += 1
-						name = self.nodeDict[link[0]]
-						'''Update node index to uniqe'''
-						link[0] = lmax+100+len(checklist.keys())+checklist[link[0]]
-						self.nodeDict[link[0]] = name
-						self.updated = True
-					except KeyError:
-						checklist[link[0]] = 0
-						## Do nothing
+				self.graph = TaxonomyGraph(self.database)
+				outputfile.write("child\tparent\trank\n")
+			elif self.unique_indexes():
+				## Links of children with duplicate index are given their unique index by the query
+				batches = self.database.iter_batches(RENUMBERED_LINKS,size=BATCHSIZE)
+			for links in batches:
 				if self.link_order:
-					link[0],link[1] = link[1],link[0]
+					links = [(parent,child,rank) for child,parent,rank in links]
 				if self.dump_descriptions:
-					link[0],link[1] = self.nodeDict[link[0]],self.nodeDict[link[1]]
-				if self.dbprogram in ["bracken"]:
-					link = list(link)+["-"]
-				if self.dbprogram == "kraken2":
-					link = list(link)+["",""] ## Make sure to add enough extra columns so that kraken2 does not trim away nessesary columns
-				if not self.minimal:
-					link = list(link)+[""]
-				print(*link, sep=self.separator, end="\n", file=outputfile)
+					links = [(self.graph.get_name(child),self.graph.get_name(parent),rank) for child,parent,rank in links]
+				outputfile.write("".join(["{}{}{}{}{}{}".format(child,sep,parent,sep,rank,end) for child,parent,rank in links]))
 
 	def names(self):
-		'''Write node annotations to names.dmp'''
-		logging.info('Write annotations to: {}{}.dmp'.format(self.path,self.prefix[0]))
-		end = "\n"
-		if self.dbprogram in ["krakenuniq","kraken2"]:
-			end = "\t|\n"
-		with open('{}{}.dmp'.format(self.path,self.prefix[0]),"w") as outputfile:
-			## Retrieve all nodes that exists in the database
-			if self.updated:
-				nodes = self.nodeDict.items()
+		'''Write node annotations to names.dmp, nodes are streamed from the database and written in batches'''
+		logging.info('Write annotations to: {}{}.dmp{}'.format(self.path,self.prefix[0],self.suffix))
+		end = self.line_ends(self.dbprogram,self.minimal,self.separator)[1]
+		with self.open('{}.dmp'.format(self.prefix[0])) as outputfile:
+			## Retrieve all nodes that exists in the database, followed by the unique indexes of duplicated children
+			batches = self.get_all('nodes', 'id,name', batches=True)
+			if not self.dump_descriptions and self.unique_indexes():
+				batches = chain(batches,self.database.iter_batches(RENUMBERED_NAMES,size=BATCHSIZE))
+			self.write_rows(outputfile, batches, sep=self.separator, end=end)
+
+	def flavours(self, programs=False):
+		'''Output settings of each program flavour, without programs the settings of the object are used
+			and the files are written to the output folder, otherwise each flavour is written to a subfolder
+
+		------
+		Returns
+			list - (output folder, (separator, end of nodes rows), (separator, end of names rows))
+		'''
+		if not programs:
+			nodes_end,names_end = self.line_ends(self.dbprogram,self.minimal,self.separator)
+			return [(self.path,(self.separator,nodes_end),(self.separator,names_end))]
+		settings = []
+		for program in programs:
+			if program not in FLAVOURS:
+				raise InputError("Unknown program flavour {program}, choose from {flavours}".format(program=program,flavours=", ".join(FLAVOURS)))
+			sep = self.dump_separator
+			if program == "minimal":
+				if sep == "\t|\t":
+					sep = "\t"
+				nodes_end,names_end = self.line_ends(None,True,sep)
 			else:
-				nodes = self.get_all('nodes', 'id,name')
-			empty = ""
-			for node in nodes:
-				if not self.minimal:
-					empty = ""
-					if self.dbprogram == "bracken":
-						empty = "-"
-					node = list(node) + [empty,"scientific name"]
-				print(*node, sep=self.separator, end=end, file=outputfile)
+				nodes_end,names_end = self.line_ends(program,False,sep)
+			settings.append(("{}{}/".format(self.path,program),(sep,nodes_end),(sep,names_end)))
+		return settings
+
+	def dump_files(self, path):
+		'''Paths of the names and nodes files written to an output folder
+
+		------
+		Returns
+			tuple - names file, nodes file
+		'''
+		return '{}{}.dmp{}'.format(path,self.prefix[0],self.suffix),'{}{}.dmp{}'.format(path,self.prefix[1],self.suffix)
+
+	def export_files(self, programs=False, taxid_map=True):
+		'''Paths of all files export writes with the same arguments, e.g. to check for existing files before a dump
+
+		------
+		Returns
+			list - file paths
+		'''
+		files = []
+		for path,nodes_format,names_format in self.flavours(programs):
+			names,nodes = self.dump_files(path)
+			files += [nodes,names]
+		if taxid_map:
+			files += [self.path+"seqid2taxid.map"+self.suffix,self.path+"prelim_map.txt"+self.suffix]
+		return files
+
+	def row_format(self, columns, sep="\t", end="\n", start=""):
+		'''Format string of an output row with a number of columns'''
+		escape = lambda text: text.replace("{","{{").replace("}","}}")
+		return escape(start)+escape(sep).join(["{}"]*columns)+escape(end)
+
+	def read_table(self, queries, queues, cancel, transform=None, renumbered=False):
+		'''Reader thread of export, streams the queries on its own read only connection and passes each batch
+			to the queues of all writers of the table. renumbered (link, id, child) rows are loaded into temp.renumbered first.
+			The reader stops when cancel is set and sets it when it fails itself
+		'''
+		database = False
+		try:
+			database = DatabaseFunctions(self.database.database, profile="readonly")
+			if renumbered:
+				self.renumber(database,renumbered)
+			for query in queries:
+				for rows in database.iter_batches(query,size=BATCHSIZE):
+					if transform:
+						rows = transform(rows)
+					for queue in queues:
+						if not put(queue,rows,cancel):
+							return
+		except BaseException:
+			cancel.set()
+			raise
+		finally:
+			if database:
+				database.conn.close()
+			for queue in queues:
+				put(queue,None,cancel)  ## end of table
+
+	def write_queue(self, files, queue, rowformat, header, cancel):
+		'''Writer thread of export, each batch of the queue is formatted once and written to all files.
+			A failed writer (e.g. an output file that cannot be opened) sets cancel so that no reader waits for it
+		'''
+		outputfiles = []
+		try:
+			for name in files:
+				outputfiles.append(open_output(name,threads=self.threads,buffering=BUFFERSIZE))
+			for outputfile in outputfiles:
+				outputfile.write(header)
+			for rows in batches(queue,cancel):
+				text = "".join([rowformat.format(*row) for row in rows])
+				for outputfile in outputfiles:
+					outputfile.write(text)
+		except BaseException:
+			cancel.set()
+			raise
+		finally:
+			for outputfile in outputfiles:
+				outputfile.close()
+
+	def export(self, programs=False, taxid_map=True):
+		'''Write names.dmp, nodes.dmp and the taxid maps (seqid2taxid.map and prelim_map.txt) in one pass over
+			the database. The tree, nodes and genomes tables are read once each by a reader thread, every batch is
+			passed on to one writer thread per output format. A list of programs (see FLAVOURS) writes the
+			names and nodes files of each program to a subfolder of the output folder from the same scan
+
+		------
+		Returns
+			list - files written
+		'''
+		flavours = self.flavours(programs)
+		self.database.commit()  ## readers use their own connections
+		## Files with the same format share a writer, each batch is formatted once per format
+		nodes_files,names_files = {},{}
+		for path,nodes_format,names_format in flavours:
+			os.makedirs(path,exist_ok=True)
+			names,nodes = self.dump_files(path)
+			nodes_files.setdefault(nodes_format,[]).append(nodes)
+			names_files.setdefault(names_format,[]).append(names)
+		header = ""
+		links_query = ["SELECT child,parent,rank FROM tree JOIN (rank) on rank.rank_i = tree.rank_i"]
+		names_query = ["SELECT id,name FROM nodes"]
+		renumbered = False
+		if self.dump_descriptions:
+			self.graph = TaxonomyGraph(self.database)
+			header = "child\tparent\trank\n"
+		elif self.unique_indexes():
+			## The unique indexes of duplicated children are assigned once and passed on to the readers
+			renumbered = self.database.fetch_all("SELECT link,id,child FROM temp.renumbered")
+			links_query = [RENUMBERED_LINKS]
+			names_query += [RENUMBERED_NAMES]
+
+		def links(rows):
+			if self.link_order:
+				rows = [(parent,child,rank) for child,parent,rank in rows]
+			if self.dump_descriptions:
+				rows = [(self.graph.get_name(child),self.graph.get_name(parent),rank) for child,parent,rank in rows]
+			return rows
+
+		writers = {"tree": [], "nodes": [], "genomes": []}
+		for (sep,end),files in nodes_files.items():
+			writers["tree"].append((files,self.row_format(3,sep,end),header))
+		for (sep,end),files in names_files.items():
+			writers["nodes"].append((files,self.row_format(2,sep,end),""))
+		if taxid_map:
+			writers["genomes"].append(([self.path+"seqid2taxid.map"+self.suffix],self.row_format(2),""))
+			writers["genomes"].append(([self.path+"prelim_map.txt"+self.suffix],self.row_format(2,start="TAXID\t"),""))
+		files = [name for table in writers.values() for names,rowformat,header in table for name in names]
+		logger.info("Export {files}".format(files=", ".join(files)))
+		queues = {table: [Queue(QUEUESIZE) for writer in writers[table]] for table in writers}
+		threads = sum(len(queues[table]) for table in queues)+len(queues)
+		cancel = Event()  ## set by the first thread that fails, all other threads stop waiting on their queues
+		with ThreadPoolExecutor(max_workers=threads) as executor:
+			futures = []
+			for table in writers:
+				for (names,rowformat,header),queue in zip(writers[table],queues[table]):
+					futures.append(executor.submit(self.write_queue,names,queue,rowformat,header,cancel))
+			futures.append(executor.submit(self.read_table,links_query,queues["tree"],cancel,transform=links,renumbered=renumbered))
+			futures.append(executor.submit(self.read_table,names_query,queues["nodes"],cancel,renumbered=renumbered))
+			if taxid_map:
+				futures.append(executor.submit(self.read_table,["SELECT genome,id FROM genomes"],queues["genomes"],cancel))
+			try:
+				for future in futures:
+					future.result()
+			except BaseException:
+				cancel.set()
+				raise
+		return files
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3 -c
+
+'''
+AccessionIndex keeps a persistent SQLite side database with all (accession, taxid) rows of an
+NCBI accession2taxid file. The index is keyed by size, mtime and hash of the source file, as long
+as the source file is unchanged later runs look up their accessions with an indexed query instead
+of reading the whole file again.
+'''
+
+import sqlite3
+import hashlib
+import os
+from itertools import islice
+import logging
+logger = logging.getLogger(__name__)
+
+class AccessionIndex(object):
+	"""AccessionIndex, persistent accession to taxid lookup table."""
+	def __init__(self, path):
+		super(AccessionIndex, self).__init__()
+		self.path = path
+
+	def connect(self, path=False):
+		conn = sqlite3.connect(path or self.path)
+		conn.execute("PRAGMA temp_store = MEMORY")
+		return conn
+
+	def file_hash(self, source, size=1 << 24):
+		'''Hash the content of the source file
+
+		------
+		Returns
+			str - md5 hex digest
+		'''
+		md5 = hashlib.md5()
+		with open(source, "rb") as f:
+			for block in iter(lambda: f.read(size), b""):
+				md5.update(block)
+		return md5.hexdigest()
+
+	def is_current(self, source):
+		'''Check if the index was built from the current version of source, the file is only hashed
+			when the size matches but the mtime differs (e.g. a copied or touched file)
+
+		------
+		Returns
+			boolean
+		'''
+		if not os.path.exists(self.path):
+			return False
+		conn = self.connect()
+		try:
+			row = conn.execute("SELECT size,mtime,hash FROM source").fetchone()
+		except sqlite3.DatabaseError:
+			logger.warning("{path} is not a valid accession index".format(path=self.path))
+			return False
+		finally:
+			conn.close()
+		if not row:
+			return False
+		size,mtime,_hash = row
+		stat = os.stat(source)
+		if size != stat.st_size:
+			return False
+		if mtime == stat.st_mtime:
+			return True
+		if _hash != self.file_hash(source):
+			return False
+		conn = self.connect()
+		conn.execute("UPDATE source SET mtime = ?", (stat.st_mtime,))
+		conn.commit()
+		conn.close()
+		return True
+
+	def build(self, source, rows, chunksize=500000):
+		'''Build the index from an iterable of (accession, taxid), the index is written to a temporary
+			file and moved in place when complete so that an interrupted build is never used
+
+		------
+		Returns
+			int - number of rows in the index
+		'''
+		logger.info("Build accession index {path} from {source}".format(path=self.path,source=source))
+		stat = os.stat(source)
+		tmp = "{path}.tmp".format(path=self.path)
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		conn = self.connect(tmp)
+		conn.execute("PRAGMA journal_mode = OFF")
+		conn.execute("PRAGMA synchronous = OFF")
+		conn.execute("CREATE TABLE accessions (accession BLOB NOT NULL, taxid BLOB NOT NULL)")
+		conn.execute("CREATE TABLE source (path TEXT, size INTEGER, mtime REAL, hash TEXT)")
+		total = 0
+		rows = iter(rows)
+		while True:
+			chunk = list(islice(rows, chunksize))
+			if not chunk:
+				break
+			conn.executemany("INSERT INTO accessions(accession,taxid) VALUES (?,?)", chunk)
+			total += len(chunk)
+			logger.debug("accession index: {total} rows processed".format(total=total))
+		## The index is built once all rows are loaded, much faster than keeping it updated during the load
+		conn.execute("CREATE INDEX accession_idx ON accessions (accession)")
+		conn.execute("INSERT INTO source(path,size,mtime,hash) VALUES (?,?,?,?)", (os.path.abspath(source),stat.st_size,stat.st_mtime,self.file_hash(source)))
+		conn.commit()
+		conn.close()
+		os.replace(tmp, self.path)
+		logger.info("Accession index built, {total} accessions".format(total=total))
+		return total
+
+	def lookup(self, accessions):
+		'''Look up accessions in the index
+
+		------
+		Returns
+			generator - (accession, taxid) in the order of the source file
+		'''
+		conn = self.connect()
+		conn.execute("CREATE TEMP TABLE search (accession BLOB PRIMARY KEY) WITHOUT ROWID")
+		conn.executemany("INSERT OR IGNORE INTO temp.search(accession) VALUES (?)", ((accession,) for accession in accessions))
+		## CROSS JOIN keeps search as the outer loop, otherwise the planner scans the whole index in rowid order
+		QUERY = '''SELECT accessions.accession,taxid FROM temp.search CROSS JOIN accessions ON (accessions.accession = search.accession) ORDER BY accessions.rowid'''
+		logger.debug(QUERY)
+		try:
+			yield from conn.execute(QUERY)
+		finally:
+			conn.close()
@@ -13,6 +13,22 @@ class ConnectionError(Exception):
 
 '''Create SQL database'''
 
+'''The schema version is stored in PRAGMA user_version, each entry in MIGRATIONS upgrades a database
+    from the previous version, databases created before versioning was introduced have version 0
+'''
+SCHEMA_VERSION = 1
+MIGRATIONS = {
+    1: [
+        "CREATE INDEX IF NOT EXISTS tree_child ON tree (child)",
+        "CREATE INDEX IF NOT EXISTS tree_parent_rank ON tree (parent, rank_i)",
+        "CREATE INDEX IF NOT EXISTS nodes_name_nocase ON nodes (name COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS genomes_id ON genomes (id)",
+    ],
+}
+
+'''Indexes created by the migrations (index name to statement), bulk loads drop them and an interrupted load may leave them missing'''
+INDEXES = {statement.split()[5]: statement for version in sorted(MIGRATIONS) for statement in MIGRATIONS[version] if statement.startswith("CREATE INDEX IF NOT EXISTS")}
+
 class CreateDatabase(object):
     """docstring for CreateDatabase"""
     def __init__(self, verbose=False):
@@ -70,6 +86,42 @@ class CreateDatabase(object):
         except Exception as e:
             logger.debug(e)
 
+    def get_schema_version(self,conn):
+        '''Return the schema version of the database (PRAGMA user_version)'''
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def upgrade_database(self,conn):
+        ''' upgrade an existing database in place to the current schema version
+        :param conn: Connection object
+        :return: schema version of the database
+        '''
+        version = self.get_schema_version(conn)
+        if version >= SCHEMA_VERSION:
+            self.restore_indexes(conn)
+            return version
+        logger.info("Upgrade database schema from version {old} to {new}".format(old=version,new=SCHEMA_VERSION))
+        for version in range(version+1,SCHEMA_VERSION+1):
+            for statement in MIGRATIONS[version]:
+                logger.debug(statement)
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = {version}".format(version=version))
+            conn.commit()
+        return version
+
+    def restore_indexes(self,conn):
+        ''' recreate indexes of the current schema that are missing, e.g. after an interrupted bulk load
+        :param conn: Connection object
+        :return: list of recreated index names
+        '''
+        existing = set([row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")])
+        missing = [name for name in INDEXES if name not in existing]
+        for name in missing:
+            logger.warning("Index {name} is missing (an earlier load did not finish), recreate index".format(name=name))
+            conn.execute(INDEXES[name])
+        if missing:
+            conn.commit()
+        return missing
+
     def add_table(self,table):
         self.create_table(table)
         self.conn.commit()
@@ -87,6 +139,8 @@ class CreateDatabase(object):
             self.create_table(self.sql_create_genomes_table)
             # create rank tables
             self.create_table(self.sql_create_rank_table)
+            # create indexes and set schema version
+            self.upgrade_database(self.conn)
 
             self.conn.commit()
         else:
@@ -1,7 +1,11 @@
 import sys
 import os
 import sqlite3
+import atexit
 import logging
+from itertools import islice
+from urllib.request import pathname2url
+from .CreateDatabase import CreateDatabase
 logger = logging.getLogger(__name__)
 
 class ConnectionError(Exception):
@@ -22,14 +26,47 @@ class TreeError(Exception):
 	def __str__(self):
 		return repr(self.value)
 
+'''SQLite settings applied to new connections, selected by name (--db_profile)
+	safe		- sqlite3 defaults with durable writes
+	bulk		- WAL journal without fsync, large page cache, in memory temp tables and memory mapped reads,
+				  durable settings are restored and the journal is checkpointed when the program exits
+	readonly	- the database is opened read only (mode=ro) with a large page cache and memory mapped reads
+	immutable	- as readonly but sqlite also skips all locking (immutable=1), only for databases no process writes to
+'''
+CACHED_STATEMENTS = 512  ## Size of the prepared statement cache of each connection (sqlite3 default is 128)
+
+PROFILES = {
+	"safe": [],
+	"bulk": [
+		"PRAGMA journal_mode = WAL",
+		"PRAGMA synchronous = OFF",
+		"PRAGMA cache_size = -524288",		## 512Mb
+		"PRAGMA temp_store = MEMORY",
+		"PRAGMA mmap_size = 4294967296",
+	],
+	"readonly": [
+		"PRAGMA cache_size = -524288",
+		"PRAGMA temp_store = MEMORY",
+		"PRAGMA mmap_size = 4294967296",
+	],
+}
+PROFILES["immutable"] = PROFILES["readonly"]
+READONLY = ("readonly","immutable")
+
 class DatabaseConnection(object):
 	"""docstring for DatabaseConnection"""
-	def __init__(self, database, verbose=False):
+	profile = "safe"  ## Default profile of new connections, changed by set_profile
+
+	def __init__(self, database, verbose=False, profile=None):
 		super().__init__()
 		self.verbose = verbose
 		self.database = database
+		if profile:
+			if profile not in PROFILES:
+				raise ConnectionError("Unknown database profile {profile}, choose from {profiles}".format(profile=profile,profiles=", ".join(PROFILES)))
+			self.profile = profile
 		BASE_DIR = os.path.dirname(os.path.abspath(__file__))  ## Retrieve path
-		if not os.path.exists(self.database):
+		if not os.path.exists(self.database) and self.profile not in READONLY:
 			if self.verbose:
 				logger.debug("python {path}/CreateDatabase.py {database}".format(path=BASE_DIR,database=self.database))
 			os.system("python {path}/CreateDatabase.py {database}".format(path=BASE_DIR,database=self.database))
@@ -39,6 +76,8 @@ class DatabaseConnection(object):
 			logger.debug("Connecting to {database}".format(database=self.database))
 			self.conn = self.connect(self.database)
 			self.cursor = self.create_cursor(self.conn)
+			if self.profile not in READONLY:
+				self.upgrade()
 
 	def __str__(self):
 		return "Object of class DatabaseConnection, connected to {database}".format(database=self.database)
@@ -63,13 +102,65 @@ class DatabaseConnection(object):
 			connection object (sqlite3)
 		'''
 		try:
-			self.conn = sqlite3.connect(database)
+			if self.profile in READONLY:
+				uri = "file:{path}?mode=ro".format(path=pathname2url(os.path.abspath(database)))
+				if self.profile == "immutable":
+					uri += "&immutable=1"
+				self.conn = sqlite3.connect(uri,uri=True,cached_statements=CACHED_STATEMENTS)
+			else:
+				self.conn = sqlite3.connect(database,cached_statements=CACHED_STATEMENTS)
+			for pragma in PROFILES[self.profile]:
+				self.conn.execute(pragma)
+			if self.profile == "bulk":
+				atexit.register(self.restore)
 			logger.info("{database} opened successfully.".format(database=database))
+			logger.debug("Database profile: {profile}".format(profile=self.profile))
 			return self.conn
 		except Exception as e:
 			sys.stderr.write(str(e))
 		raise ConnectionError("Count not connect to the database {database} see above message for details!".format(database=database))
 
+	@classmethod
+	def set_profile(cls,profile):
+		'''Set the profile used by all new connections (see PROFILES)
+
+		------
+		Returns
+			str - selected profile'''
+		if profile not in PROFILES:
+			raise ConnectionError("Unknown database profile {profile}, choose from {profiles}".format(profile=profile,profiles=", ".join(PROFILES)))
+		DatabaseConnection.profile = profile
+		return profile
+
+	def restore(self):
+		'''Restore durable settings after a bulk run, the WAL journal is checkpointed into the database file
+			and the connection is closed. If other connections still use the journal the last one to close restores it.
+			A transaction that is still open was not committed by the program (e.g. it stopped on an exception)
+			and is rolled back, as sqlite does when a connection is closed.
+		'''
+		try:
+			if self.conn.in_transaction:
+				logger.warning("Rolling back uncommitted changes to {database}".format(database=self.database))
+			self.conn.rollback()
+			self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+			self.conn.execute("PRAGMA journal_mode = DELETE")
+			self.conn.execute("PRAGMA synchronous = FULL")
+			logger.debug("Durable settings restored on {database}".format(database=self.database))
+		except sqlite3.Error as e:
+			logger.debug("Could not restore durable settings on {database}: {e}".format(database=self.database,e=e))
+		finally:
+			self.conn.close()
+		return
+
+	def upgrade(self):
+		'''Upgrade the database schema (indexes) in place if the database was created by an older version
+
+		------
+		Returns
+			int - schema version of the database
+		'''
+		return CreateDatabase().upgrade_database(self.conn)
+
 	def create_cursor(self,conn):
 		'''Create a db cursor
 
@@ -117,6 +208,79 @@ class DatabaseConnection(object):
 				sys.stderr.write(str(e)+"\n")
 			return(e)
 
+	def fetch_one(self,query,params=()):
+		'''Execute a query with bound parameters (fixed SQL text is reused from the statement cache)
+
+		------
+		Returns
+			tuple - first row of the result, None if there are no rows
+		'''
+		return self.cursor.execute(query,params).fetchone()
+
+	def fetch_all(self,query,params=()):
+		'''Execute a query with bound parameters
+
+		------
+		Returns
+			list - all rows of the result
+		'''
+		return self.cursor.execute(query,params).fetchall()
+
+	def iter_rows(self,query,params=(),size=10000):
+		'''Execute a query with bound parameters on a separate cursor and stream the result,
+			other queries can be executed while the rows are consumed
+
+		------
+		Returns
+			generator - rows of the result
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute(query,params)
+		while True:
+			rows = cursor.fetchmany(size)
+			if not rows:
+				break
+			yield from rows
+		cursor.close()
+
+	def iter_batches(self,query,params=(),size=100000):
+		'''Execute a query with bound parameters on a separate cursor and stream the result in batches
+
+		------
+		Returns
+			generator - lists of at most size rows
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute(query,params)
+		while True:
+			rows = cursor.fetchmany(size)
+			if not rows:
+				break
+			yield rows
+		cursor.close()
+
+	def temp_table(self,rows,name="ids",columns=("id",)):
+		'''Load rows into an indexed TEMP table so that large sets can be joined instead of inlined into the SQL text,
+			rows of a single column table may be given as plain values. An existing temp table with the same name is replaced.
+
+		------
+		Returns
+			str - name of the temp table (temp.name)
+		'''
+		table = "temp.{name}".format(name=name)
+		cols = ",".join(columns)
+		pending = self.conn.in_transaction
+		cursor = self.conn.cursor()  ## Own cursor, rows may still be streamed from the main cursor
+		cursor.execute("DROP TABLE IF EXISTS {table}".format(table=table))
+		cursor.execute("CREATE TABLE {table} ({cols}, UNIQUE ({cols}))".format(table=table,cols=cols))
+		if len(columns) == 1:
+			rows = ((row,) for row in rows)
+		cursor.executemany("INSERT OR IGNORE INTO {table} VALUES ({values})".format(table=table,values=",".join(["?" for x in columns])),rows)
+		cursor.close()
+		if not pending:  ## Do not leave a transaction open (and the database locked) only for the temp table
+			self.commit()
+		return table
+
 	def insert(self,data,table):
 		'''Insert function
 				data is a dictionary with keys matching
@@ -138,6 +302,65 @@ class DatabaseConnection(object):
 		)
 		return self.query(insertStr,insert_val=values)
 
+	def insert_many(self,rows,table,columns,chunksize=50000,hold=False):
+		'''Bulk insert function
+				rows is an iterable of tuples ordered as columns, rows are
+				chunked into executemany calls within one transaction and rows
+				violating a unique constraint are skipped (ON CONFLICT DO NOTHING)
+		------
+		Returns
+			tuple - (inserted, ignored) number of rows
+		'''
+		INSERT_QUERY = '''
+			INSERT INTO {table}({columns})
+			VALUES ({values})
+			ON CONFLICT DO NOTHING
+		'''.format(
+				table=table,
+				columns=",".join(columns),
+				values=",".join(["?" for x in columns])
+		)
+		inserted = 0
+		total = 0
+		rows = iter(rows)
+		cursor = self.conn.cursor()
+		while True:
+			chunk = list(islice(rows, chunksize))
+			if not chunk:
+				break
+			cursor.executemany(INSERT_QUERY,chunk)
+			inserted += cursor.rowcount
+			total += len(chunk)
+			logger.debug("{table}: {total} rows processed".format(table=table,total=total))
+		## Commit changes
+		if not hold:
+			self.commit()
+		return inserted,total-inserted
+
+	def drop_indexes(self,tables):
+		'''Drop the secondary indexes of tables before a large bulk load, building an index
+			once after the load is much faster than updating it for every row. If the load does not finish,
+			the next writable connection recreates the missing schema indexes (CreateDatabase.restore_indexes)
+
+		------
+		Returns
+			list - CREATE INDEX statements of the dropped indexes, see create_indexes
+		'''
+		QUERY = '''SELECT name,sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({tables})'''.format(tables=",".join("?" for t in tables))
+		indexes = self.fetch_all(QUERY,tuple(tables))
+		for name,sql in indexes:
+			logger.debug("DROP INDEX {name}".format(name=name))
+			self.conn.execute("DROP INDEX {name}".format(name=name))
+		self.commit()
+		return [sql for name,sql in indexes]
+
+	def create_indexes(self,indexes):
+		'''Rebuild indexes returned by drop_indexes'''
+		for sql in indexes:
+			logger.debug(sql)
+			self.conn.execute(sql)
+		self.commit()
+
 	def update(self,data,table):
 		'''Update function requires table column which column to identify row with and value to replace
 
@@ -212,93 +435,115 @@ class DatabaseFunctions(DatabaseConnection):
 	"""DatabaseFunctions class defines additional functions to the DatabaseConnection class
 
 	"""
-	def __init__(self, database, verbose=False):
-		super().__init__(database, verbose)
+	def __init__(self, database, verbose=False, profile=None):
+		super().__init__(database, verbose, profile)
+		self.genome_cache = {}
 		logger.debug("Load DatabaseFunctions")
 
 	'''Validate tree function'''
 	def validate_tree(self):
 		'''This function validates the tree structure in the databases
 			1. All nodes must only have one parent (check_parent)
-			2. All edges must be attatched to the tree (match tree links and edges)
+			2. There may be no cycles in the tree (check_cycles)
 			3. All nodes must be attatched to the tree (match tree nodes and nodes)
-			4. All nodes from links must have a node description (match the number of nodes from links with number of annotated nodes)
+			4. All edges must be attatched to the tree (match tree links and edges)
+			5. All nodes from links must have a node description (match the number of nodes from links with number of annotated nodes)
+
+			All checks are run as queries in the database, only counts and a small sample of failing nodes are fetched
 
 		------
 		Returns
 			True: if all edges has one and only one parent
 		'''
-		self.taxonomy = self.get_nodes()
-
-		logger.info("Get all database nodes")
-		self.nodes = self.get_nodes(col=1)					## get all nodes
-		logger.info("Get all database edges")
-		self.edges = self.get_links()					## Get all links
 		logger.info("Get all children from root node")
-		self.tree_connections = self.get_children([1])  ## Get all chilren from root
-		logger.info("Get tree edges from children")
-		self.tree_links = self.get_links(self.tree_connections) ## get all links from rooted tree
-		logger.info("Get nodes from tree edges")
-		self.tree_nodes = set()
-		for edge in self.edges:
-			self.tree_nodes.add(edge[0])
-			self.tree_nodes.add(edge[1])
+		self.query("DROP TABLE IF EXISTS temp.tree_nodes")
+		self.query('''CREATE TEMP TABLE tree_nodes AS WITH RECURSIVE descendants(id) AS (
+						SELECT child FROM tree WHERE parent = 1
+						UNION
+						SELECT tree.child FROM tree JOIN descendants ON tree.parent = descendants.id
+					) SELECT id FROM descendants''')
+		self.query("CREATE UNIQUE INDEX temp.tree_nodes_id ON tree_nodes (id)")
 		logger.info("Validate parents")
 		res = self.check_parent()
 		extra = ""
 		if len(res) > 0:
-			failed_nodes = [self.nodes[x[0]] for x in list(res)]
+			failed_nodes = [name[0] for name in self.fetch_all("SELECT name FROM nodes WHERE id in ({ids})".format(ids=",".join(["?" for x in res[:10]])),[x[0] for x in res[:10]])]
 			logger.debug(failed_nodes)
-			if len(failed_nodes) > 10:
-				logger.info(failed_nodes[:10])
-				failed_nodes = len(failed_nodes)
+			if len(res) > 10:
+				logger.info(failed_nodes)
+				failed_nodes = len(res)
 				extra = "total failed nodes: "
 			raise TreeError("There are nodes with multiple parents {extra}{nodes}".format(nodes=failed_nodes,extra=extra))
+		logger.info("Count nodes and edges")
 		stats = """Tree statistics
 					Nodes: {nodes}
 					Links: {links}
 					Tree: n({tnodes}), l({tlinks})
 					LinkNodes: {link_nodes}
 					Parent_ok: True
-					""".format(nodes = len(self.nodes),
-								links=len(self.edges),
-								tnodes=len(self.tree_connections),
-								tlinks = len(self.tree_links),
-								link_nodes = len(self.tree_nodes)
+					""".format(nodes = self.num_rows("nodes"),
+								links=self.num_rows("tree"),
+								tnodes=self.num_rows("temp.tree_nodes"),
+								tlinks = self.fetch_one("SELECT count(*) FROM tree WHERE child in (SELECT id FROM temp.tree_nodes)")[0],
+								link_nodes = self.fetch_one("SELECT count(*) FROM (SELECT parent FROM tree UNION SELECT child FROM tree)")[0]
 		)
 		logger.info(stats)
-		nodeset = set(self.nodes.keys())
-		if len(nodeset - self.tree_connections) != 0:
-			lset = nodeset - self.tree_connections
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
-			raise TreeError("The number of nodes and the number nodes under root does not match!")
-		if len(set(self.edges) - set(self.tree_links)) != 0:
-			lset = set(self.edges) - set(self.tree_links)
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
-			raise TreeError("The number of edges and the number edges under root does not match!")
-		if len(self.tree_nodes - nodeset) != 0:
-			lset = self.tree_nodes - nodeset
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
-			raise TreeError("The number of annotated nodes does not match with the number of nodes connected to edges!")
-		if len(self.tree_connections - nodeset) != 0:
-			lset = self.tree_connections - nodeset
-			if len(lset) > 10:
-				lset = len(lset)
-				#logger.debug([self.taxonomy[x] for x in lset])
-			logger.info("{}".format(lset))
-			raise TreeError("There are nodes in the database not connected to the tree")
+		checks = [
+			("SELECT id FROM nodes WHERE id NOT IN (SELECT id FROM temp.tree_nodes)",
+				"The number of nodes and the number nodes under root does not match!"),
+			("SELECT parent,child,rank_i FROM tree WHERE child NOT IN (SELECT id FROM temp.tree_nodes)",
+				"The number of edges and the number edges under root does not match!"),
+			("SELECT parent FROM tree WHERE parent NOT IN (SELECT id FROM nodes) UNION SELECT child FROM tree WHERE child NOT IN (SELECT id FROM nodes)",
+				"The number of annotated nodes does not match with the number of nodes connected to edges!"),
+			("SELECT id FROM temp.tree_nodes WHERE id NOT IN (SELECT id FROM nodes)",
+				"There are nodes in the database not connected to the tree"),
+		]
+		for QUERY,message in checks:
+			failed,lset = self.validation_sample(QUERY)
+			if failed != 0:
+				if failed > 10:
+					lset = failed
+				logger.info("{}".format(lset))
+				if message == checks[0][1]:
+					self.check_cycles()
+				raise TreeError(message)
 		logger.info("Validation OK!")
 		return True
 
+	def validation_sample(self,query,limit=10):
+		'''Count the rows returned by a validation query and fetch a bounded sample of them
+
+		------
+		Returns
+			tuple - (number of rows, set with at most limit rows)
+		'''
+		logger.debug(query)
+		sample = self.fetch_all("{query} LIMIT {limit}".format(query=query,limit=limit+1))
+		count = len(sample)
+		if count > limit:  ## Only count all rows when the sample is not the complete result
+			count = self.fetch_one("SELECT count(*) FROM ({query})".format(query=query))[0]
+		return count,set([row[0] if len(row) == 1 else row for row in sample[:limit]])
+
+	def check_cycles(self):
+		'''check tree structure for cycles, only nodes not attached to root can be part of a cycle without having two parents
+		------
+		Returns
+			True: if there are no cycles
+		'''
+		## Walk upwards from every edge not attached to root, a walk that returns to its start is a cycle
+		QUERY = '''WITH RECURSIVE up(start,node) AS (
+					SELECT child,parent FROM tree WHERE child NOT IN (SELECT id FROM temp.tree_nodes) AND parent != child
+					UNION
+					SELECT up.start,tree.parent FROM tree JOIN up ON tree.child = up.node WHERE tree.parent != tree.child
+				) SELECT DISTINCT start FROM up WHERE start = node'''
+		failed,lset = self.validation_sample(QUERY)
+		if failed != 0:
+			if failed > 10:
+				lset = failed
+			logger.info("{}".format(lset))
+			raise TreeError("There are {n} nodes in cycles not connected to the tree".format(n=failed))
+		return True
+
 	def statistics(self):
 		'''Print statistics of the database
 
@@ -329,29 +574,20 @@ class DatabaseFunctions(DatabaseConnection):
 			make sure no tree node has multiple parents
 		------
 		Returns
-			True: if node has one and only one parent
+			list: nodes with multiple parents sharing identical parent links (empty if the tree is ok)
 		'''
-		try:
-			QUERY = "SELECT child FROM tree GROUP BY child HAVING count(parent) > 1"  ## Thanks to andrewjmc@github for this suggestion
-			logger.debug(QUERY)
-			child_w_dp = self.query(QUERY).fetchall()
-			QUERY = "SELECT parent,rank_i FROM tree WHERE child in ({children})".format(children=",".join(map(str,list(*child_w_dp))))
-			p_ranks = self.query(QUERY).fetchall()
-			if len(p_ranks) != len(set(p_ranks)):
-				logger.error("Nodes with two parents have identical ranks, Fatal Error")
-			elif len(child_w_dp) > 0:
-				logger.info("Found: {n} nodes with multiple parents, however in different lineages, OK.".format(n=len(child_w_dp)))
-				return []
-			return child_w_dp
-		except AttributeError:
-			logger.info("AttributeError occured")
-			logger.info(QUERY)
-			logger.info(child_w_dp)
-		except TypeError:
-			logger.info("TypeError occured")
-			logger.info(QUERY)
-			logger.info(child_w_dp)
-		raise TreeError("Following Nodes: {node} has more than one parent!".format(node=child_w_dp))
+		QUERY = "SELECT child FROM tree GROUP BY child HAVING count(parent) > 1"  ## Thanks to andrewjmc@github for this suggestion
+		logger.debug(QUERY)
+		child_w_dp = self.fetch_one("SELECT count(*) FROM ({query})".format(query=QUERY))[0]
+		if child_w_dp == 0:
+			return []
+		DUPLICATES = "SELECT parent,rank_i FROM tree WHERE child in ({query}) GROUP BY parent,rank_i HAVING count(*) > 1".format(query=QUERY)
+		logger.debug(DUPLICATES)
+		if self.fetch_one(DUPLICATES) is not None:
+			logger.error("Nodes with two parents have identical ranks, Fatal Error")
+			return self.fetch_all(QUERY)
+		logger.info("Found: {n} nodes with multiple parents, however in different lineages, OK.".format(n=child_w_dp))
+		return []
 
 	'''Get functions of class'''
 	def get_all(self, database=False, table=False,sort=False):
@@ -399,6 +635,20 @@ class DatabaseFunctions(DatabaseConnection):
 			genomeDict[genome] = id
 		return genomeDict
 
+	def get_genome_taxid(self, genome):
+		'''Get the node a genome is annotated to, lookups are cached on the connection
+
+		------
+		Returns
+			int - node id, None if the genome is not annotated
+		'''
+		try:
+			return self.genome_cache[genome]
+		except KeyError:
+			res = self.fetch_one("SELECT id FROM genomes WHERE genome = ?",(genome,))
+			self.genome_cache[genome] = res[0] if res else None
+		return self.genome_cache[genome]
+
 	def get_node(self, name, database=False):
 		'''Retrieve one node by name
 
@@ -406,10 +656,8 @@ class DatabaseFunctions(DatabaseConnection):
 		Returns
 			list - list with node id
 		'''
-		QUERY = '''SELECT id FROM nodes where name = "{name}"'''.format(name=name)
-		if not database:
-			database = self.database
-		return [n[0] for n in self.query(QUERY).fetchall()]
+		QUERY = '''SELECT id FROM nodes WHERE name = ?'''
+		return [n[0] for n in self.fetch_all(QUERY,(name,))]
 
 	def get_nodes(self, database=False,col=5):
 		'''Retrieve the whole node info table of the database to decrease the number of database calls!
@@ -444,12 +692,14 @@ class DatabaseFunctions(DatabaseConnection):
 		if swap:
 			order[1],order[0] = order[0],order[1]
 
+		if nodes:
+			nodes = self.temp_table(nodes,name="link_nodes")
 		if only_parents and nodes:
-			QUERY = '''SELECT {order} FROM tree WHERE child in ({nodes})'''.format(nodes=",".join(map(str,nodes)),order=",".join(order))
+			QUERY = '''SELECT {order} FROM tree WHERE child in (SELECT id FROM {nodes})'''.format(nodes=nodes,order=",".join(order))
 		elif nodes and order:
-			QUERY = '''SELECT {order} FROM tree WHERE child in ({nodes}) ORDER BY parent ASC'''.format(nodes=",".join(map(str,nodes)),order=",".join(order))
+			QUERY = '''SELECT {order} FROM tree WHERE child in (SELECT id FROM {nodes}) ORDER BY parent ASC'''.format(nodes=nodes,order=",".join(order))
 		elif nodes:
-			QUERY = '''SELECT {order} FROM tree WHERE parent in ({nodes}) OR child in ({nodes})'''.format(nodes=",".join(map(str,nodes)),order=",".join(order))
+			QUERY = '''SELECT {order} FROM tree WHERE parent in (SELECT id FROM {nodes}) OR child in (SELECT id FROM {nodes})'''.format(nodes=nodes,order=",".join(order))
 		else:
 			QUERY = '''SELECT {order} FROM tree'''.format(order=",".join(order))
 		logger.debug(QUERY)
@@ -568,6 +818,44 @@ class DatabaseFunctions(DatabaseConnection):
 			self.commit()
 		return added_nodes
 
+	'''Bulk add functions of class'''
+	def bulk_add_nodes(self, nodes, table="nodes", hold=False):
+		'''Add nodes from an iterable of (id, name) in one transaction,
+			if id is None the next free id is assigned by the database
+
+		Returns
+		------
+			tuple - (inserted, ignored) number of nodes
+		'''
+		rows = ((id,name) for id,name in nodes if name.strip() != "")  ## do not add empty nodes
+		inserted,ignored = self.insert_many(rows, table=table, columns=("id","name"), hold=hold)
+		logger.debug("Nodes added: {inserted}, ignored: {ignored}".format(inserted=inserted,ignored=ignored))
+		return inserted,ignored
+
+	def bulk_add_links(self, links, table="tree", hold=False):
+		'''Add links from an iterable of (parent, child, rank_i) in one transaction
+
+		Returns
+		------
+			tuple - (inserted, ignored) number of links
+		'''
+		inserted,ignored = self.insert_many(links, table=table, columns=("parent","child","rank_i"), hold=hold)
+		logger.debug("Links added: {inserted}, ignored: {ignored}".format(inserted=inserted,ignored=ignored))
+		return inserted,ignored
+
+	def bulk_add_genomes(self, genomes, table="genomes", hold=False):
+		'''Add genome annotations from an iterable of (genome, id, reference) in one transaction,
+			genomes already annotated in the database keep their annotation
+
+		Returns
+		------
+			tuple - (inserted, ignored) number of genomes
+		'''
+		rows = ((genome,_id,reference or None) for genome,_id,reference in genomes)
+		inserted,ignored = self.insert_many(rows, table=table, columns=("genome","id","reference"), hold=hold)
+		logger.debug("Genomes added: {inserted}, ignored: {ignored}".format(inserted=inserted,ignored=ignored))
+		return inserted,ignored
+
 	'''Delete functions of class'''
 	def delete_links(self,links, table="tree",hold=False):
 		'''This function deletes all links given in links
@@ -577,13 +865,11 @@ class DatabaseFunctions(DatabaseConnection):
 			boolean
 		'''
 		logger.info("Slow clean")
-		QUERY = "DELETE FROM {table} WHERE parent = {parent} AND child = {child} AND rank_i = {rank_i}"
+		QUERY = "DELETE FROM {table} WHERE parent = ? AND child = ? AND rank_i = ?".format(table=table)
 		logger.debug("Deleting {nlinks} links!".format(nlinks=len(links)))
-		logger.debug(QUERY.format(table=table,parent="",child="",rank_i=""))
+		logger.debug(QUERY)
 		logger.info("{links}".format(links=len(links)))
-		for parent,child,rank in links:
-			logger.debug("{}-{} rank: {} deleted!".format(parent,child,rank))
-			res = self.query(QUERY.format(table=table, parent=parent, child=child, rank_i=rank))
+		self.cursor.executemany(QUERY,((parent,child,rank) for parent,child,rank in links))
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -591,22 +877,18 @@ class DatabaseFunctions(DatabaseConnection):
 		return True
 
 	def fast_delete_links(self,links,table="tree",hold=False):
-		'''This function is used when general clean function is executed
+		'''This function is used when general clean function is executed, the links (parent,child,rank_i)
+			are loaded into a temp table and exactly those links are deleted
 		Returns
 		------
 			boolean
 		'''
 		logger.info("Fast clean")
-		parents = set()
-		children = set()
-		QUERY = "DELETE FROM {table} WHERE parent in ({parents}) AND child in ({children})"
 		logger.debug("Deleting {nlinks} links!".format(nlinks=len(links)))
-		for parent,child,rank in links:
-			parents |= set([parent])
-			children |= set([child])
-			#logger.debug("{}-{} rank: {} deleted!".format(parent,child,rank))
-		logger.debug(QUERY.format(table=table,parents=len(parents),children=len(children)))
-		res = self.query(QUERY.format(table=table, parents=",".join(list(map(str,parents))), children=",".join(list(map(str,children)))))
+		links = self.temp_table(links,name="delete_links",columns=("parent","child","rank_i"))
+		QUERY = "DELETE FROM {table} WHERE (parent,child,rank_i) in (SELECT parent,child,rank_i FROM {links})".format(table=table,links=links)
+		logger.debug(QUERY)
+		res = self.query(QUERY)
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -620,10 +902,11 @@ class DatabaseFunctions(DatabaseConnection):
 			boolean
 		'''
 		logger.info("Entered ambigious_delete_links")
-		QUERY = "DELETE FROM {table} WHERE parent in ({parents}) AND child in ({children})"
 		logger.info("Attempting delete where parent&child in: ")
 		logger.debug( str(nodes))
-		res = self.query(QUERY.format(table='tree', parents=",".join(list(map(str,nodes))), children=",".join(list(map(str,nodes)))))
+		nodes = self.temp_table(nodes,name="delete_nodes")
+		QUERY = "DELETE FROM {table} WHERE parent in (SELECT id FROM {nodes}) AND child in (SELECT id FROM {nodes})".format(table='tree',nodes=nodes)
+		res = self.query(QUERY)
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -637,10 +920,11 @@ class DatabaseFunctions(DatabaseConnection):
 		------
 			boolean
 		'''
-		QUERY = "DELETE FROM {table} WHERE id in ({nodes})"
 		logger.debug("Deleting {nnodes} nodes!".format(nnodes=len(nodes)))
-		logger.debug(QUERY.format(table=table,nodes=""))
-		res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes)))))
+		nodes = self.temp_table(nodes,name="delete_nodes")
+		QUERY = "DELETE FROM {table} WHERE id in (SELECT id FROM {nodes})".format(table=table,nodes=nodes)
+		logger.debug(QUERY)
+		res = self.query(QUERY)
 		## Commit changes
 		if not hold:
 			logger.debug("Commit changes!")
@@ -656,24 +940,22 @@ class DatabaseFunctions(DatabaseConnection):
 		'''
 		if genomes: # check if genomes were specified for targeted deletion (sometimes a node can hold multiple genomes)
 			if not match_genome_only:
-				QUERY = "DELETE FROM {table} WHERE id in({nodes}) AND genome in({genomes})"
+				QUERY = "DELETE FROM {table} WHERE id in (SELECT id FROM {nodes}) AND genome in (SELECT genome FROM {genomes})"
 			else:
-				QUERY = "DELETE FROM {table} WHERE genome in({genomes})"
+				QUERY = "DELETE FROM {table} WHERE genome in (SELECT genome FROM {genomes})"
 		else:
-			QUERY = "DELETE FROM {table} WHERE id in({nodes})"
+			QUERY = "DELETE FROM {table} WHERE id in (SELECT id FROM {nodes})"
 
 		logger.info("Deleting {nnodes} annotations!".format(nnodes=len(nodes)))
 		#for node in nodes:
 			#logger.info("Delete genomes from: {node}".format(node=node))
 		if genomes:
-			if not match_genome_only:
-				logger.debug(QUERY.format(table=table,nodes="",genomes=""))
-				res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes))), genomes='"'+'","'.join(list(map(str,genomes)))+'"'))
-			else:
-				res = self.query(QUERY.format(table=table, genomes='"'+'","'.join(list(map(str,genomes)))+'"'))
-		else:
-			logger.debug(QUERY.format(table=table,nodes=""))
-			res = self.query(QUERY.format(table=table, nodes=",".join(list(map(str,nodes)))))
+			genomes = self.temp_table(map(str,genomes),name="delete_genomes",columns=("genome",))
+		if not match_genome_only or not genomes:
+			nodes = self.temp_table(nodes,name="delete_nodes")
+		QUERY = QUERY.format(table=table,nodes=nodes,genomes=genomes)
+		logger.debug(QUERY)
+		res = self.query(QUERY)
 		
 		## Commit changes
 		if not hold:
@@ -694,8 +976,8 @@ class DatabaseFunctions(DatabaseConnection):
 
 class ModifyFunctions(DatabaseFunctions):
 	"""ModifyFunctions adds nessesary functions when modifying a database"""
-	def __init__(self, database, verbose=False):
-		super().__init__(database, verbose)
+	def __init__(self, database, verbose=False, profile=None):
+		super().__init__(database, verbose, profile)
 		logger.debug("Load ModifyFunctions")
 
 	def get_rank(self,col=1):
@@ -715,33 +997,46 @@ class ModifyFunctions(DatabaseFunctions):
 			rankDict[rank[1]] = rank[0]
 		return rankDict
 
-	def get_children(self,parents,children=set(),level=0,maxdepth=50,selected=False):
+	def get_descendants(self,parents,maxdepth=0,selected=False):
+		'''Get all descendants of a set of parents using a single recursive query
+
+			maxdepth limits the number of levels walked below the parents (0 walks the whole subtree),
+			selected restricts the first level of children to links of that rank_i
+
+		------
+		Returns
+			sqlite3.Cursor - streamed rows of (child,) for every unique descendant
+		'''
+		nodes = self.temp_table(map(int,parents),name="descendant_parents")
+		rank = ""
+		if selected:
+			rank = " AND rank_i = {rank}".format(rank=int(selected))
+		if maxdepth:
+			## The depth column makes rows unique per level, the self link of root is skipped to keep the walk finite
+			QUERY = '''WITH RECURSIVE descendants(child,depth) AS (
+						SELECT child,1 FROM tree WHERE parent in (SELECT id FROM {nodes}){rank}
+						UNION
+						SELECT tree.child,descendants.depth+1 FROM tree JOIN descendants ON tree.parent = descendants.child
+							WHERE tree.parent != tree.child AND descendants.depth < {maxdepth}
+					) SELECT DISTINCT child FROM descendants'''.format(nodes=nodes,rank=rank,maxdepth=int(maxdepth))
+		else:
+			## UNION discards already visited nodes which also stops the walk on cycles
+			QUERY = '''WITH RECURSIVE descendants(child) AS (
+						SELECT child FROM tree WHERE parent in (SELECT id FROM {nodes}){rank}
+						UNION
+						SELECT tree.child FROM tree JOIN descendants ON tree.parent = descendants.child
+					) SELECT child FROM descendants'''.format(nodes=nodes,rank=rank)
+		logger.debug(QUERY)
+		return self.query(QUERY)
+
+	def get_children(self,parents,maxdepth=0,selected=False):
 		'''Get all children from a parent
 
 		Returns
 		------
 			set - unique list of children from a decending tree
 		'''
-		if level >= maxdepth:
-			return children
-
-		QUERY = '''SELECT child FROM tree WHERE parent in({nodes})'''.format(nodes=",".join(map(str,list(parents))))
-
-		if selected:
-			QUERY = '''SELECT child FROM tree WHERE parent in({nodes}) and rank_i = {rank}'''.format(nodes=",".join(map(str,list(parents))), rank=selected)
-		#logger.debug(QUERY)
-		#print(QUERY)
-		res = self.query(QUERY).fetchall()
-		if (len(res) + len(children)) != 0:
-			children = set([child_i[0] for child_i in res])
-			if level < maxdepth:
-				try:
-					children |= self.get_children(parents=children,level=level+1,maxdepth=maxdepth)
-				except RecursionError:
-					logger.debug('Maximum depth reached, halting tree traversal')
-					return children
-
-		return children
+		return set([child_i[0] for child_i in self.get_descendants(parents,maxdepth=maxdepth,selected=selected)])
 
 	def get_parent(self,name,all=False):
 		'''Get parent from node id parent
@@ -751,13 +1046,10 @@ class ModifyFunctions(DatabaseFunctions):
 			list - parent link and rank
 		'''
 		#QUERY = '''SELECT parent,child,rank FROM tree LEFT JOIN rank on (tree.rank_i = rank.rank_i) WHERE child = "{node}"'''.format(node=name)
-		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = "{node}"'''.format(node=name)
-		logger.debug(QUERY)
+		QUERY = '''SELECT parent,child,rank_i FROM tree WHERE child = ?'''
 		if all:
-			res = self.query(QUERY).fetchall()
-		else:
-			res = self.query(QUERY).fetchone()
-		return res
+			return self.fetch_all(QUERY,(name,))
+		return self.fetch_one(QUERY,(name,))
 
 	def parse_parents(self,parents):
 		pret = set()
@@ -766,73 +1058,80 @@ class ModifyFunctions(DatabaseFunctions):
 			pret |= set([int(pc[1])])
 		return pret
 
-	def get_parents(self,name,parents=set(),depth=0,find_all=False,simple=False,ncbi=False):
+	def get_ancestors(self,nodes):
+		'''Get the ancestor closure of a set of nodes using a single recursive query,
+			the nodes themselves are included if they are linked in the tree
+
+		------
+		Returns
+			sqlite3.Cursor - streamed rows of (node,) for every unique node on the paths to root
+		'''
+		nodes = self.temp_table(map(int,nodes),name="ancestor_nodes")
+		## UNION discards already visited nodes, the walk therefore ends at the root self link and on cycles
+		QUERY = '''WITH RECURSIVE ancestors(node) AS (
+					SELECT child FROM tree WHERE child in (SELECT id FROM {nodes})
+					UNION
+					SELECT tree.parent FROM tree JOIN ancestors ON tree.child = ancestors.node
+				) SELECT node FROM ancestors'''.format(nodes=nodes)
+		logger.debug(QUERY)
+		return self.query(QUERY)
+
+	def lineage(self,taxid):
+		'''Get the lineage of a node, ordered from root down to the node itself
+
+		------
+		Returns
+			list - (taxid, rank) for every node on the path from root to taxid
+		'''
+		## Each row is the link above a node, path holds all visited children so that a revisit stops the walk and is reported
+		QUERY = '''WITH RECURSIVE lineage(parent,child,rank_i,depth,path,cycle) AS (
+					SELECT parent,child,rank_i,0,'/'||child||'/',0 FROM tree WHERE child = {node}
+					UNION ALL
+					SELECT tree.parent,tree.child,tree.rank_i,lineage.depth+1,lineage.path||tree.child||'/',
+							tree.parent != tree.child AND instr(lineage.path||tree.child||'/','/'||tree.parent||'/') > 0
+						FROM tree JOIN lineage ON tree.child = lineage.parent
+						WHERE lineage.parent != lineage.child AND NOT lineage.cycle
+				) SELECT child,rank,depth,cycle FROM lineage LEFT JOIN rank ON (lineage.rank_i = rank.rank_i) ORDER BY depth DESC,lineage.rank_i ASC'''.format(node=int(taxid))
+		logger.debug(QUERY)
+		res = self.query(QUERY).fetchall()
+		if len(res) == 0:
+			logger.warning("WARNING: parent could not be found for node {node}".format(node=taxid))
+			return []
+		if res[0][3]:
+			logger.error("ERROR: cycle found in lineage of {node}".format(node=taxid))
+			raise TreeError("cycle found in lineage of {node}".format(node=taxid))
+		lineage = []
+		depth = False
+		for child,rank,_depth,cycle in res:
+			if _depth == depth:
+				if child == lineage[-1][0]:  ## The same node linked with more than one rank (root)
+					continue
+				logger.error("ERROR: cannot fetch lineage when parents are duplicated!")
+				raise TreeError("cannot fetch lineage of {node} when parents are duplicated!".format(node=taxid))
+			lineage.append((child,rank))
+			depth = _depth
+		return lineage
+
+	def get_parents(self,name,find_all=False,**kwargs):
 		'''Get all parents until root
 
+			find_all returns the ancestor closure of all nodes in name (including the nodes),
+			otherwise the parents of the single node in name are returned
+
 		Returns
 		------
-			list - all parents of a node
+			set - all parents of a node
 		'''
-		ld = depth+1
-		lmax = 12
-		if ncbi and depth == 0:
-			logger.info("NCBI mode on, minimum level to check 50 (since euk has red many levels) Will take time!")
-		lmax = 50
-		if simple:
-			simple=""
-		else:
-			simple=",rank_i"
+		if isinstance(name, int):
+			name = [name]
 		try:
 			name = set(list(map(int,name))) ## Make sure all names are int
 		except TypeError:
 			name = set(list(map(int,[x[0] for x in name]))) ## Make sure all names are int
-		if isinstance(name, int):
-			name = [name]
-		if len(name & set([1])) > 0 and not ncbi:
-			#print(name)
-			return parents
-		QUERY = '''SELECT parent,child{simple} FROM tree WHERE child in ({node})'''.format(simple=simple, node=",".join(map(str,name)))
-		#if find_all: logger.info(QUERY)
-		res = self.query(QUERY).fetchall()
-		if not find_all:
-			try:
-				res = int(res[0])
-			except IndexError:
-				logger.warning("WARNING: parent could not be found for node {res} \n{query}".format(query=QUERY, res=name))
-				return set()
-			except TypeError:
-				#print(res)
-				logger.error("ERROR: cannot fetch parents when parents are duplicated!")
-				raise TreeError("cannot fetch parents when parents are duplicated!")
-			if res[0] == res[1]:  ## Special for root
-				return set([res[0]])
-			else:
-				## Add all parents
-				try:
-					#if ncbi:
-					#	logger.info("Loop depth: {ld}".format(ld=ld))
-					parents |= self.get_parents([int(res[0])],depth=ld,ncbi=ncbi)
-
-				except RecursionError:
-					print(res, name)
-			## Add current node
-			parents |= set([int(res[0])])
-		else:
-			parents = self.parse_parents(res) #set([(int(pc[0]),int(pc[-1])) for pc in res])
-			if len(parents-name) == 1 and ld > lmax:  ## There are no more parents to fetch
-				return parents
-			else:
-				## Add all parents
-				if ld > lmax:
-					return parents
-				try:
-					#if ncbi:
-					#	logger.info("Loop depth: {ld}".format(ld=ld))
-					parents |= self.get_parents(parents,find_all=find_all,depth=ld,ncbi=ncbi)
-				except RecursionError:
-					logger.info("RecursionError, node requested")
-					print(res, name)
-		return parents
+		if find_all:
+			return set([node[0] for node in self.get_ancestors(name)])
+		node = name.pop()
+		return set([taxid for taxid,rank in self.lineage(node) if taxid != node])
 
 	def get_id(self,name):
 		'''get node id from name
@@ -841,13 +1140,12 @@ class ModifyFunctions(DatabaseFunctions):
 		------
 			int - node id from node name
 		'''
-		QUERY = '''SELECT id FROM nodes WHERE name = "{node}" COLLATE NOCASE'''.format(node=name)
-		try:
-			res = self.query(QUERY).fetchone()[0]
-		except TypeError:
-			logger.debug(QUERY)
+		QUERY = '''SELECT id FROM nodes WHERE name = ? COLLATE NOCASE'''
+		res = self.fetch_one(QUERY,(name,))
+		if res is None:
+			logger.debug("{query} {name}".format(query=QUERY,name=name))
 			raise NameError("Name not found in the database! {name}".format(name=name))
-		return res
+		return res[0]
 
 	def get_name(self,id):
 		'''get node name from id
@@ -856,13 +1154,12 @@ class ModifyFunctions(DatabaseFunctions):
 		------
 			char - node id from node name
 		'''
-		QUERY = '''SELECT name FROM nodes WHERE id = "{node}" COLLATE NOCASE'''.format(node=id)
-		try:
-			res = self.query(QUERY).fetchone()[0]
-		except TypeError:
-			logger.debug(QUERY)
-			raise NameError("Name not found in the database! {name}".format(name=name))
-		return res
+		QUERY = '''SELECT name FROM nodes WHERE id = ?'''
+		res = self.fetch_one(QUERY,(id,))
+		if res is None:
+			logger.debug("{query} {id}".format(query=QUERY,id=id))
+			raise NameError("Id not found in the database! {id}".format(id=id))
+		return res[0]
 
 	def update_table(self,data,table):
 		'''Add annotation to table
@@ -881,3 +1178,23 @@ class ModifyFunctions(DatabaseFunctions):
 			see update responses
 		'''
 		return self.update_table(data, table="genomes")
+
+
+'''Worker processes must not use a connection inherited from the parent process (fork),
+	each worker opens and keeps its own read only connection instead'''
+_worker_connections = {}
+
+def worker_connection(database, immutable=False):
+	'''Connection factory for worker processes, the connection of the calling process is opened on first use
+
+	------
+	Returns
+		DatabaseFunctions - read only connection owned by the current process
+	'''
+	key = (os.getpid(),database)
+	if key not in _worker_connections:
+		profile = "readonly"
+		if immutable:
+			profile = "immutable"
+		_worker_connections[key] = DatabaseFunctions(database, profile=profile)
+	return _worker_connections[key]
@@ -5,6 +5,7 @@ from os import makedirs,path,walk
 import glob
 import logging
 from time import sleep
+from collections import deque
 logger = logging.getLogger(__name__)
 
 SUPPORTED_TAXONOMIC_GROUPS = [
@@ -190,3 +191,18 @@ def read_skip_file(fin):
 				fc = row.strip().split("\t")[0]
 				ldict.add(fc)
 	return result
+
+def imap_bounded(pool,func,iterable,window):
+	'''Ordered map of func over iterable on a multiprocessing pool, at most window tasks are in
+		flight so that a fast producer (e.g. a file reader) is not read ahead of the workers
+
+	Returns
+		generator - func(item) for each item in iterable, in input order
+	'''
+	pending = deque()
+	for item in iterable:
+		pending.append(pool.apply_async(func,(item,)))
+		if len(pending) > window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
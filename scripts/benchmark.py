@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the FlexTaxD taxonomy import, FASTA header scan and dump on synthetic data
+
+    python scripts/benchmark.py [load|scan|dump|all] [--nodes N] [--sequences N] [--workdir DIR]
+
+    load - import a synthetic NCBI taxdump (names.dmp and nodes.dmp) into a new database (ReadTaxonomyNCBI)
+    scan - scan an nt style FASTA file for sequence ids (ReadTaxonomyNCBI.parse_nt_file), plain and gzipped,
+           compared to reading the same file line by line
+    dump - write names.dmp and nodes.dmp from the database (WriteTaxonomy), compared to only reading
+           the rows from the database and to only writing the same number of bytes to disk
+
+The input is generated with a fixed seed so that runs on different versions can be compared, it is
+written to --workdir (a temporary folder removed at exit unless --workdir is given). dump uses the
+database of load, which is created first when it does not exist.
+'''
+
+import argparse
+import gzip
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  ## run from a source checkout
+
+from flextaxd.modules.ReadTaxonomyNCBI import ReadTaxonomyNCBI,SequenceIds
+from flextaxd.modules.WriteTaxonomy import WriteTaxonomy
+from flextaxd.modules.database.DatabaseConnection import DatabaseFunctions
+
+RANKS = ["superkingdom","phylum","class","order","family","genus","species","strain"]
+SEED = 1
+BLOCK = 1 << 20
+
+def report(name, seconds, size=False, rows=False):
+    '''Print one benchmark result with throughput and the peak memory of the process so far'''
+    rate = ""
+    if size:
+        rate += " {mb:8.1f} MB/s".format(mb=size/seconds/2**20)
+    if rows:
+        rate += " {rows:10.0f} rows/s".format(rows=rows/seconds)
+    print("{name:<36} {seconds:8.2f} s{rate}   maxrss {rss} MB".format(name=name,seconds=seconds,rate=rate,rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10))
+    sys.stdout.flush()
+
+def write_taxdump(workdir, nodes):
+    '''Write a random tree of nodes taxids in NCBI taxdump format, every fourth node also has a synonym
+
+    ------
+    Returns
+        str - path of nodes.dmp (names.dmp is written next to it)
+    '''
+    rng = random.Random(SEED)
+    nodes_dmp = os.path.join(workdir,"nodes.dmp")
+    names_dmp = os.path.join(workdir,"names.dmp")
+    with open(nodes_dmp,"w") as nf, open(names_dmp,"w") as mf:
+        nf.write("1\t|\t1\t|\tno rank\t|\tXX\t|\t0\t|\n")
+        mf.write("1\t|\troot\t|\t\t|\tscientific name\t|\n")
+        for taxid in range(2,nodes+1):
+            parent = rng.randrange(max(1,taxid-1000),taxid)
+            nf.write("{taxid}\t|\t{parent}\t|\t{rank}\t|\tXX\t|\t0\t|\n".format(taxid=taxid,parent=parent,rank=RANKS[taxid % len(RANKS)]))
+            mf.write("{taxid}\t|\ttaxon {taxid}\t|\t\t|\tscientific name\t|\n".format(taxid=taxid))
+            if taxid % 4 == 0:
+                mf.write("{taxid}\t|\tsynonym {taxid}\t|\t\t|\tsynonym\t|\n".format(taxid=taxid))
+    return nodes_dmp
+
+def write_nt(workdir, sequences):
+    '''Write an nt style FASTA file with sequences of 240 bp in lines of 80 bp, and a gzipped copy
+
+    ------
+    Returns
+        list - paths of the plain and the gzipped file
+    '''
+    rng = random.Random(SEED)
+    lines = ["".join(rng.choice("ACGT") for i in range(80))+"\n" for j in range(64)]
+    path = os.path.join(workdir,"nt")
+    with open(path,"w") as f:
+        for i in range(sequences):
+            f.write(">NZ_{i:08d}.1 synthetic sequence {i}\n".format(i=i))
+            f.write(lines[i % 64]+lines[(i*7) % 64]+lines[(i*13) % 64])
+    with open(path,"rb") as source, gzip.open(path+".gz","wb",compresslevel=1) as target:
+        shutil.copyfileobj(source,target,BLOCK)
+    return [path,path+".gz"]
+
+def bench_load(workdir, nodes):
+    '''Import the synthetic taxdump into a new database'''
+    nodes_dmp = os.path.join(workdir,"nodes.dmp")
+    if not os.path.exists(nodes_dmp):
+        t = time.time()
+        write_taxdump(workdir,nodes)
+        report("generate taxdump ({n} nodes)".format(n=nodes),time.time()-t)
+    database = os.path.join(workdir,"benchmark.db")
+    if os.path.exists(database):
+        os.remove(database)
+    size = os.path.getsize(nodes_dmp)+os.path.getsize(nodes_dmp.replace("nodes","names"))
+    t = time.time()
+    reader = ReadTaxonomyNCBI(nodes_dmp,database=database,force_multisource=False)
+    reader.parse_taxonomy()
+    report("load names.dmp+nodes.dmp",time.time()-t,size=size,rows=2*nodes)
+    return database
+
+def bench_scan(workdir, sequences):
+    '''Scan the nt file for sequence ids, plain (memory mapped) and gzipped, against a line by line loop'''
+    t = time.time()
+    paths = write_nt(workdir,sequences)
+    report("generate nt ({n} sequences)".format(n=sequences),time.time()-t)
+    size = os.path.getsize(paths[0])
+    reader = ReadTaxonomyNCBI(os.path.join(workdir,"nodes.dmp"),database=os.path.join(workdir,"scan.db"),force_multisource=False)
+    for path in paths:
+        name = os.path.basename(path)
+        t = time.time()
+        ids = {}
+        with (gzip.open(path,"rb") if path.endswith(".gz") else open(path,"rb")) as f:
+            for line in f:
+                if line.startswith(b">"):
+                    ids[line[1:].split(b" ",1)[0].rstrip()] = True
+        report("line by line {name}".format(name=name),time.time()-t,size=size,rows=len(ids))
+        reader.refseqid_to_GCF = SequenceIds()
+        t = time.time()
+        reader.parse_nt_file(path,name)
+        report("parse_nt_file {name}".format(name=name),time.time()-t,size=size,rows=len(reader.refseqid_to_GCF.nt))
+
+def bench_dump(workdir, nodes):
+    '''Dump the database and measure the database reads and the disk writes of the same data on their own'''
+    database = os.path.join(workdir,"benchmark.db")
+    if not os.path.exists(database):
+        bench_load(workdir,nodes)
+    outdir = os.path.join(workdir,"dump")
+    os.makedirs(outdir,exist_ok=True)
+    db = DatabaseFunctions(database)
+    t = time.time()
+    rows = 0
+    for query in ["SELECT child,parent,rank FROM tree JOIN rank ON (rank.rank_i = tree.rank_i)","SELECT id,name FROM nodes"]:
+        for batch in db.iter_batches(query):
+            rows += len(batch)
+    read = time.time()-t
+    report("read rows only",read,rows=rows)
+    writer = WriteTaxonomy(outdir,database=database)
+    t = time.time()
+    writer.nodes()
+    writer.names()
+    dump = time.time()-t
+    files = [os.path.join(outdir,name) for name in ["nodes.dmp","names.dmp"]]
+    size = sum(os.path.getsize(path) for path in files)
+    report("nodes() + names()",dump,size=size,rows=rows)
+    t = time.time()
+    writer.export(taxid_map=False)
+    report("export() (concurrent)",time.time()-t,size=size,rows=rows)
+    t = time.time()
+    for path in files:
+        with open(path,"rb") as source, open(path+".copy","wb") as target:
+            shutil.copyfileobj(source,target,BLOCK)
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(path+".copy")
+    write = time.time()-t
+    report("write bytes only (with fsync)",write,size=size)
+    print("dump / (read + write) = {ratio:.2f}, close to 1 when the dump is bound by database reads and disk writes".format(ratio=dump/(read+write)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FlexTaxD import, header scan and dump on synthetic data")
+    parser.add_argument("benchmark", nargs="?", default="all", choices=["load","scan","dump","all"], help="benchmark to run (default all)")
+    parser.add_argument("--nodes", type=int, default=1000000, help="number of taxonomy nodes (default 1000000)")
+    parser.add_argument("--sequences", type=int, default=500000, help="number of sequences in the nt file (default 500000)")
+    parser.add_argument("--workdir", default=None, help="folder for the generated data, kept after the run (default a temporary folder)")
+    args = parser.parse_args()
+
+    workdir = args.workdir
+    if not workdir:
+        workdir = tempfile.mkdtemp(prefix="flextaxd_benchmark_")
+    os.makedirs(workdir,exist_ok=True)
+    print("FlexTaxD benchmark in {workdir}, python {version}".format(workdir=workdir,version=sys.version.split()[0]))
+    try:
+        if args.benchmark in ["load","all"]:
+            bench_load(workdir,args.nodes)
+        if args.benchmark in ["scan","all"]:
+            bench_scan(workdir,args.sequences)
+        if args.benchmark in ["dump","all"]:
+            bench_dump(workdir,args.nodes)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()